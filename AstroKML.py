@@ -5,7 +5,7 @@
 #Usage
 #To load a region defined by a shapefile:
 #   AstroKML.py -s <Output File> <Shapefile>
-#   NOTE: The shapefile must contain a single polygon entry
+#   NOTE: The shapefile may contain any number of polygon or multipolygon entries
 #
 #To load a region defined by a bounding box:
 #   AstroKML.py -b <Output File> <MinLon> <MinLat> <MaxLon> <MaxLat>
@@ -13,32 +13,177 @@
 #To use predefined region(s):
 #   AstroKML.py -r <Output File> <Region1> ...
 #
+#To run a batch of the above, one per line of a job file:
+#   AstroKML.py -j <Job File>
+#   NOTE: each line holds the arguments of one query, quoted as on the command line,
+#         and may end with options applying only to it, other than --site, --procs,
+#         --memory, --metrics and the cache and index options, which are given before -j.
+#         A job that can't be run, such as --offline without an index, is skipped
+#
+#To answer queries over HTTP, keeping sessions and placemarks warm between them:
+#   AstroKML.py -d <Port>
+#   GET  /kml?bbox=<MinLon>,<MinLat>,<MaxLon>,<MaxLat>   a bounding box
+#   GET  /kml?region=<Region1>&region=...                 predefined region(s)
+#   POST /kml                                             a GeoJSON polygon as the body
+#   NOTE: the filter options, --tile, --tile-pages and --offline may be given
+#         with each request, such as /kml?bbox=-10,-10,10,10&from=20010101,
+#         --offline only if -d was started with --index
+#
+#Options:
+#   --threads=<N>       most placemarks fetched at once (default 8)
+#   --rate=<R>          maximum placemark requests started per second (default no limit)
+#   --page-threads=<N>  number of result pages fetched at once (default 4)
+#   --retries=<N>       times a failed request is retried (default 4)
+#   --procs=<N>         make and serialize placemarks in N worker processes (default 1)
+#   --memory=<MB>       keep about MB in all of fetched placemarks and resumed results in
+#                       memory, spilling the rest to a temporary file (default no limit)
+#   --tile=<D>          search -b and -s areas as a grid of tiles D degrees across
+#   --tile-pages=<N>    split tiles with more than N pages of results (default 5)
+#   --cache=<File>      placemark cache database (default ~/.astrokml_cache.sqlite)
+#   --cache-ttl=<D>     days before a cached placemark is fetched again (default 90, 0 never)
+#   --cache-size=<N>    maximum number of cached placemarks (default 500000, 0 no limit)
+#   --no-cache          don't read or write the placemark cache
+#   --refresh           fetch every placemark again, updating the cache
+#   --resume            continue an interrupted run from <Output File>.journal
+#   --index[=<File>]    add the photographs found to a local index for --offline
+#                       (default file ~/.astrokml_index.sqlite)
+#   --no-index          don't use the local index, even with --index or --offline
+#   --offline           answer -b and -s queries from the local index without the NASA site
+#   --from=<YYYYMMDD>   only photographs acquired on or after this date
+#   --to=<YYYYMMDD>     only photographs acquired on or before this date
+#   --mission=<M,...>   only photographs from these missions, such as ISS001,STS063
+#   --tilt=<T,...>      only these camera tilts, such as NV (nadir view),LO,HO
+#   --camera=<Text>     only cameras whose name contains Text
+#   --lens=<Text>       only lenses whose name contains Text, such as 180
+#   --sun-min=<D>       only photographs taken with the sun at least D degrees high
+#   --sun-max=<D>       only photographs taken with the sun at most D degrees high
+#   --altitude-min=<N>  only photographs taken from at least N nautical miles up
+#   --altitude-max=<N>  only photographs taken from at most N nautical miles up
+#   --leaf-size=<N>     most placemarks in each kml of a .kmz <Output File> (default 1000)
+#   --geojson=<File>    also write the photographs to File as newline-delimited GeoJSON
+#   --csv=<File>        also write the photographs to File as CSV
+#   --npz=<File>        also write the photographs to File as NumPy arrays (needs numpy)
+#   --site=<URL>        send requests to URL instead of http://eol.jsc.nasa.gov, the
+#                       default cache and index files are not used with it
+#   --metrics=<File>    write timings and counters of each stage as json to File
+#   --metrics-interval=<S> also rewrite the metrics file every S seconds while running
+#   --host=<Address>    address -d listens on (default localhost)
+#   --search-ttl=<S>    seconds -d reuses the results of a search (default 600, 0 never)
+#
 #See http://eol.jsc.nasa.gov/sseop/technical.htm for the full list of regions
 #
+#An <Output File> ending in .kmz is written as a KMZ of kml tiles that
+#Google Earth loads as they come into view, see --leaf-size
+#
 #
 #Dependencies:
 #mechanize 2.0.1 <http://wwwsearch.sourceforge.net/mechanize>
 #pykml 0.3 <http://code.google.com/p/pykml>
 #
-#Optional (only needed if -s option is used)
+#Optional (only needed if -s option is used, numpy also for --npz,
+#shapely and numpy also for GeoJSON polygons sent to -d)
 #
 #gdal 1.7.1 <http://trac.osgeo.org/gdal/wiki/GdalOgrInPython>
 #shapely 1.2 <http://trac.gispython.org/lab/wiki/Shapely>
+#numpy 1.3 <http://numpy.scipy.org>
 
-import urllib2,sys,mechanize,re,time
+import sys,os,mechanize,re,time,random,threading,Queue,sqlite3,json,itertools,contextlib,shlex,cPickle
+import httplib,urlparse,socket,zlib,zipfile,tempfile,array,collections,multiprocessing,csv
+import BaseHTTPServer,SocketServer
 from pykml.factory import KML_ElementMaker as K
+from lxml import etree
 
 #used to find various parts of the webpages that are parsed
 pagefinder = re.compile("Page <b>\d+</b> of <b>\d+</b><br>")
 trfinder = re.compile("</tr>")
 startfinder = re.compile("<th>Quick View</th>")
 endfinder = re.compile("</TABLE></CENTER>")
-topfinder = re.compile("<TD valign=\"top\">[\-\. a-zA-Z0-9]*</TD>")
-targetfinder = re.compile("target=\"_blank\">[ a-zA-Z0-9]*</A></TD>")
-tdfinder = re.compile("</TD>")
+datefinder = re.compile("(?<!\d)(\d{4})[-/]?(\d\d)[-/]?(\d\d)(?!\d)")
+
+#matches a row of the results table, capturing Mission, Roll, Frame, the
+#two cells after the frame (date and time) and Latitude and Longitude if
+#they are present.
+#rowskip moves lazily to the next match without leaving the row
+topcell = "<TD valign=\"top\">([\-\. a-zA-Z0-9]*)</TD>"
+rowskip = "(?:(?!</tr>).)*?"
+rowfinder = re.compile(topcell + rowskip + topcell + rowskip +
+                       "target=\"_blank\">([ a-zA-Z0-9]*)</A></TD>" +
+                       "((?:" + rowskip + "</TD>){2})" +
+                       "(?:" + rowskip + topcell + rowskip + topcell + ")?",re.S)
+
+#finds the fields of a PhotoKML.pl document in one pass, capturing either
+#a tag and its text, or a <STRONG> label and the text after it up to the
+#next &nbsp; or </P>
+fieldfinder = re.compile("<(?:(name|color|longitude|latitude)>([^<]*)|" +
+                         "STRONG>([^<]*)</STRONG>: ([^&<]*(?:(?:&(?!nbsp)|<(?!/P>))[^&<]*)*))")
 
 shape = None
 
+#html of the search form, see openSearchForm
+formpage = None
+
+mrfkey = "%(Mission)s-%(Roll)s-%(Frame)s"
+
+#tiles are not split below this many degrees across
+mintile = 0.01
+
+#deepest level of the quadtree dividing the placemarks of a kmz
+maxdepth = 16
+
+#options that may be given with each request to -d, see PhotoServer
+requestoptions = ["from","to","mission","tilt","camera","lens","sun-min","sun-max","altitude-min","altitude-max",
+                  "tile","tile-pages","offline"]
+
+#those of requestoptions that are on or off, such as offline=1
+requestflags = ["offline"]
+
+#options that apply to the whole of a -j batch, so can't be given on its lines
+batchoptions = ["site","procs","memory","cache","cache-ttl","cache-size","no-cache","refresh",
+                "index","no-index","metrics","metrics-interval","host","search-ttl"]
+
+#most prepared GeoJSON polygons kept by -d
+shapecache = 64
+
+#most searches whose images are kept by -d, see --search-ttl
+searchcache = 64
+
+#columns written by the --geojson, --csv and --npz outputs: the name of
+#each, as in the ExtendedData of a placemark, and its placemark attribute
+exportfields = [("MRF","MRF"),("IMG","IMG"),("features","Features"),("YYYYMMDD","YYYYMMDD"),
+                ("HHMMSS","HHMMSS"),("Camera_Tilt","Camera Tilt"),("Camera_Lens","Camera Lens"),
+                ("Camera","Camera"),("Sun_Azimuth","Sun Azimuth"),("Sun_Elevation","Sun Elevation"),
+                ("Spacecraft_Altitude","Spacecraft Altitude"),("DB_Entry","DB Entry")]
+
+#quotes a string as json
+quote = json.encoder.encode_basestring_ascii
+
+#the columns kept as numbers by --npz
+numericfields = ["Sun_Azimuth","Sun_Elevation","Spacecraft_Altitude"]
+
+#placemarks in each chunk made by a worker process of --procs, and the
+#most chunks waiting to be written at once
+renderchunk = 200
+renderwindow = 32
+
+#every request is made to siteurl, see setSite
+siteurl = "http://eol.jsc.nasa.gov"
+placemarkurl = siteurl + "/scripts/sseop/PhotoKML.pl?photo=" + mrfkey
+
+#closes the document opened by kmlHeader()
+kmlfooter = "</Document></kml>"
+
+#namespace declarations made by a placemark serialized on its own
+nsdecl = etree.tostring(K.Placemark())[len("<Placemark"):-len("/>")]
+
+cachefile = os.path.join(os.path.expanduser("~"),".astrokml_cache.sqlite")
+indexfile = os.path.join(os.path.expanduser("~"),".astrokml_index.sqlite")
+
+#seconds a run waits for another run writing to the cache or index
+dbtimeout = 30.0
+
+#most seconds between commits of the index
+commitinterval = 1.0
+
 def usage():
     '''Prints script usage'''
     print """
@@ -47,7 +192,7 @@ covering a user specified region
 
 To load a region defined by a shapefile:
     python AstroKML.py -s <Output File> <Shapefile>
-    NOTE: The shapefile must contain a single polygon entry
+    NOTE: The shapefile may contain any number of polygon or multipolygon entries
 
 To load a region defined by a bounding box:
     python AstroKML.py -b <Output File> <MinLon> <MinLat> <MaxLon> <MaxLat>
@@ -55,65 +200,396 @@ To load a region defined by a bounding box:
 To use predefined region(s):
     python AstroKML.py -r <Output File> <Region1> ...
 
-See http://eol.jsc.nasa.gov/sseop/technical.htm for the full list of regions"""
+To run a batch of the above, one per line of a job file:
+    python AstroKML.py -j <Job File>
+    NOTE: each line holds the arguments of one query, quoted as on the command line,
+          and may end with options applying only to it, other than --site, --procs,
+          --memory, --metrics and the cache and index options, which are given before -j.
+          A job that can't be run, such as --offline without an index, is skipped
+
+To answer queries over HTTP, keeping sessions and placemarks warm between them:
+    python AstroKML.py -d <Port>
+    GET  /kml?bbox=<MinLon>,<MinLat>,<MaxLon>,<MaxLat>   a bounding box
+    GET  /kml?region=<Region1>&region=...                 predefined region(s)
+    POST /kml                                             a GeoJSON polygon as the body
+    NOTE: the filter options, --tile, --tile-pages and --offline may be given
+          with each request, such as /kml?bbox=-10,-10,10,10&from=20010101,
+          --offline only if -d was started with --index
+
+See http://eol.jsc.nasa.gov/sseop/technical.htm for the full list of regions
+
+An <Output File> ending in .kmz is written as a KMZ of kml tiles that
+Google Earth loads as they come into view, see --leaf-size
+
+Options (placed anywhere on the command line):
+    --threads=<N>       most placemarks fetched at once (default 8)
+    --rate=<R>          maximum placemark requests started per second (default no limit)
+    --page-threads=<N>  number of result pages fetched at once (default 4)
+    --retries=<N>       times a failed request is retried (default 4)
+    --procs=<N>         make and serialize placemarks in N worker processes (default 1)
+    --memory=<MB>       keep about MB in all of fetched placemarks and resumed results in
+                        memory, spilling the rest to a temporary file (default no limit)
+    --tile=<D>          search -b and -s areas as a grid of tiles D degrees across
+    --tile-pages=<N>    split tiles with more than N pages of results (default 5)
+    --cache=<File>      placemark cache database (default ~/.astrokml_cache.sqlite)
+    --cache-ttl=<D>     days before a cached placemark is fetched again (default 90, 0 never)
+    --cache-size=<N>    maximum number of cached placemarks (default 500000, 0 no limit)
+    --no-cache          don't read or write the placemark cache
+    --refresh           fetch every placemark again, updating the cache
+    --resume            continue an interrupted run from <Output File>.journal
+    --index[=<File>]    add the photographs found to a local index for --offline
+                        (default file ~/.astrokml_index.sqlite)
+    --no-index          don't use the local index, even with --index or --offline
+    --offline           answer -b and -s queries from the local index without the NASA site
+    --from=<YYYYMMDD>   only photographs acquired on or after this date
+    --to=<YYYYMMDD>     only photographs acquired on or before this date
+    --mission=<M,...>   only photographs from these missions, such as ISS001,STS063
+    --tilt=<T,...>      only these camera tilts, such as NV (nadir view),LO,HO
+    --camera=<Text>     only cameras whose name contains Text
+    --lens=<Text>       only lenses whose name contains Text, such as 180
+    --sun-min=<D>       only photographs taken with the sun at least D degrees high
+    --sun-max=<D>       only photographs taken with the sun at most D degrees high
+    --altitude-min=<N>  only photographs taken from at least N nautical miles up
+    --altitude-max=<N>  only photographs taken from at most N nautical miles up
+    --leaf-size=<N>     most placemarks in each kml of a .kmz <Output File> (default 1000)
+    --geojson=<File>    also write the photographs to File as newline-delimited GeoJSON
+    --csv=<File>        also write the photographs to File as CSV
+    --npz=<File>        also write the photographs to File as NumPy arrays (needs numpy)
+    --site=<URL>        send requests to URL instead of http://eol.jsc.nasa.gov, the
+                        default cache and index files are not used with it
+    --metrics=<File>    write timings and counters of each stage as json to File
+    --metrics-interval=<S> also rewrite the metrics file every S seconds while running
+    --host=<Address>    address -d listens on (default localhost)
+    --search-ttl=<S>    seconds -d reuses the results of a search (default 600, 0 never)"""
+
+def getOptions(args):
+    '''Separates --name=value options from the positional arguments
+
+Returns: (dict of options, list of remaining arguments)'''
+    options = {}
+    rest = []
+
+    for arg in args:
+        if arg.startswith("--"):
+            name,sep,value = arg[2:].partition("=")
+            options[name] = value if sep else True
+        else:
+            rest += [arg]
+
+    return options,rest
+
+def setSite(url):
+    '''Sends every request to url instead of eol.jsc.nasa.gov, such as a local mirror'''
+    global siteurl
+    global placemarkurl
+    global formpage
+    siteurl = url.rstrip("/")
+    formpage = None
+    placemarkurl = siteurl + "/scripts/sseop/PhotoKML.pl?photo=" + mrfkey
+
+def newBrowser(jar=None):
+    '''Returns: a browser session keeping its cookies in jar, or in a jar of its own'''
+    br = mechanize.Browser()
+    br.set_cookiejar(mechanize.CookieJar() if jar == None else jar)
+    br.set_handle_gzip(True)
+    return br
 
 def main():
     '''Handles command line options'''
 
-    br = mechanize.Browser()
+    options,args = getOptions(sys.argv[1:])
 
-    args = sys.argv[1:]
+    if "site" in options:
+        setSite(options["site"])
 
-    #The -s option uses a shapefile provided by the user
-    if args[0] == '-s':
-        if not len(args) == 3:
+    try:
+        photoFilter(options)
+    except ValueError, e:
+        print "--" + str(e)
+        sys.exit(2)
+
+    #the worker processes are started before any threads, so none of
+    #their locks are copied into the workers while held
+    pool = None
+    if int(options.get("procs",1)) > 1:
+        pool = multiprocessing.Pool(int(options["procs"]))
+
+    if "metrics" in options and "metrics-interval" in options:
+        metrics.emit(options["metrics"],float(options["metrics-interval"]))
+
+    if len(args) == 0:
+        usage()
+        sys.exit(2)
+
+    #help option
+    if args[0] == "-h" or args[0] == "help":
+        usage()
+        return
+
+    if args[0] == '-j':
+        if not len(args) == 2:
+            usage()
+            sys.exit(2)
+        jobs = readJobs(args[1])
+    elif args[0] == '-d':
+        if not (len(args) == 2 and args[1].isdigit()):
             usage()
             sys.exit(2)
+        jobs = []
+    elif checkArgs(args):
+        jobs = [args]
+    else:
+        usage()
+        sys.exit(2)
 
-        #osgeo and shapely are only imported if the -s option is called
-        #this allows the other two options to be independent of these modules
-        import osgeo.ogr as osr
-        import shapely as shp
-        from shapely.wkb import loads as ld
-        global osgeo
-        global shapely
-        global loads
-        osgeo = osr
-        shapely = shp
-        loads = ld
+    br = newBrowser()
+
+    #another site's photographs are kept out of the default cache and index,
+    #they are only used with --site if their files are given
+    mirrored = "site" in options
+
+    cache = None
+    if not ("no-cache" in options or (mirrored and not "cache" in options)):
+        cache = PlacemarkCache(options.get("cache",cachefile),
+                               float(options.get("cache-ttl",90))*86400,
+                               int(options.get("cache-size",500000)),
+                               "refresh" in options)
+
+    #the index is only kept when asked for, or read when a job is answered from it
+    index = None
+    wanted = "index" in options or "offline" in options or any("offline" in getOptions(job)[0] for job in jobs)
+    if wanted and not "no-index" in options:
+        fileName = options.get("index",True)
+        if not fileName == True:
+            index = PhotoIndex(fileName)
+        elif not mirrored:
+            index = PhotoIndex(indexfile)
+
+    #a batch splits the memory budget between the store and the journal
+    #of the job being run, -d has no journal
+    budget = int(float(options.get("memory",0))*1048576)
+
+    #the jobs of a batch share the browser session, http connections,
+    #cache and index, and each placemark is only fetched once between them
+    if args[0] == '-j':
+        store = PlacemarkStore((budget+1)//2)
+        for number,job in enumerate(jobs,1):
+            print "Job " + repr(number) + " of " + repr(len(jobs)) + ": " + " ".join(job)
+            jobOptions,jobArgs = getOptions(job)
+            merged = dict(options)
+            merged.update(jobOptions)
+            try:
+                runJob(jobArgs,merged,br,cache,index,store,pool)
+            except ValueError, e:
+                print "Skipping job " + repr(number) + ": " + str(e)
+    elif args[0] == '-d':
+        store = PlacemarkStore(budget)
+        server = PhotoServer((options.get("host","localhost"),int(args[1])),options,cache,index,store,pool)
+        print "Serving on http://%s:%d" % server.server_address
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+    else:
+        try:
+            runJob(args,options,br,cache,index,None,pool)
+        except ValueError, e:
+            print str(e)
+            sys.exit(2)
 
-        rs = getShape(args[2])
-        images = getImages(getBBoxResults(rs.bounds,br),br,rs)
-        writeKML(args[1],images)
+    if not pool == None:
+        pool.close()
+        pool.join()
 
-    #the -b option uses a user specified bounding box of lat/lon coords
+    if not cache == None:
+        cache.close()
+
+    if not index == None:
+        index.close()
+
+    if "metrics" in options:
+        metrics.write(options["metrics"])
+
+def checkArgs(args):
+    '''Returns: whether args are a complete -s, -b or -r query'''
+    if len(args) < 3:
+        return False
+    elif args[0] == '-s':
+        return len(args) == 3
     elif args[0] == '-b':
-        if not len(args) == 6:
-            usage()
+        return len(args) == 6
+    return args[0] == '-r'
+
+def readJobs(fileName):
+    '''Reads a job file, each line of which holds the arguments of one
+-s, -b or -r query, quoted as on the command line, and optionally options
+applying only to it, which can't be batchoptions. Blank lines and
+# comments are ignored.
+
+Returns: list of argument lists'''
+    jobs = []
+    for number,line in enumerate(open(fileName),1):
+        job = shlex.split(line,True)
+        if len(job) == 0:
+            continue
+        jobOptions,jobArgs = getOptions(job)
+        if not checkArgs(jobArgs):
+            print fileName + " line " + repr(number) + " is not a -s, -b or -r query: " + line.strip()
             sys.exit(2)
+        for name in batchoptions:
+            if name in jobOptions:
+                print fileName + " line " + repr(number) + ": --" + name + " applies to the whole batch, give it before -j"
+                sys.exit(2)
+        try:
+            photoFilter(jobOptions)
+        except ValueError, e:
+            print fileName + " line " + repr(number) + ": --" + str(e)
+            sys.exit(2)
+        jobs += [job]
+    return jobs
+
+def runJob(args,options,br,cache=None,index=None,store=None,pool=None):
+    '''Runs the -s, -b or -r query in args, writing the images found to
+its output file. cache, index, store and pool may be shared between jobs.
+A ValueError is raised, before anything is written, if the query can't be
+run.'''
+
+    threads = int(options.get("threads",8))
+    rate = float(options.get("rate",0))
+    retries = int(options.get("retries",4))
+    #the store of a batch takes the other half of the budget, see main
+    budget = int(float(options.get("memory",0))*1048576)
+    if not store == None:
+        budget = (budget+1)//2
+
+    offline = "offline" in options
+    if offline and index == None:
+        raise ValueError("--offline needs the local index")
+
+    journal = None
+    rs = None
+    photofilter = photoFilter(options)
+
+    #The -s option uses a shapefile provided by the user
+    if args[0] == '-s':
+        importShapes()
+        rs = ShapeFilter(getShape(args[2]))
+        bbox = rs.bounds
+
+    #the -b option uses a user specified bounding box of lat/lon coords
+    elif args[0] == '-b':
         print (args[2],args[3],args[4],args[5])
-        images = getImages(getBBoxResults((args[2],args[3],args[4],args[5]),br),br)
-        writeKML(args[1],images)
+        bbox = (args[2],args[3],args[4],args[5])
 
     #the -r option uses the predefined regions available in NASA's search query form
     elif args[0] == '-r':
-        if not len(args) >= 3:
-            usage()
-            sys.exit(2)
-        images = getImages(getLocationResults(args[2:],br),br)
-        writeKML(args[1],images)
+        if offline:
+            raise ValueError("Predefined regions can't be searched offline")
 
-    #help option
-    elif args[0] == "-h" or args[0] == "help":
-        usage()
+    #answer the query from the local index, or search the NASA site
+    if offline:
+        placemarks = searchIndex(index,bbox,rs,photofilter)
+        index = None
     else:
-        usage()
-        sys.exit(2)
-        
+        journal = Journal(args[1]+".journal",args,"resume" in options,budget)
+        if args[0] == '-r':
+            images = searchImages(None,args[2:],rs,options,br,journal)
+        else:
+            images = searchImages(bbox,None,rs,options,br,journal)
+
+        #drop the rows that can't match before any placemarks are fetched
+        if not photofilter == None:
+            images = filterRows(images,photofilter)
+        placemarks = fetchPlacemarks(images,threads,rate,cache,journal,retries,store,photofilter,index)
+
+    #the other formats are written in the same pass as the kml
+    sinks = []
+    if "geojson" in options:
+        sinks += [GeoJSONSink(options["geojson"])]
+    if "csv" in options:
+        sinks += [CSVSink(options["csv"])]
+    if "npz" in options:
+        sinks += [NPZSink(options["npz"])]
+
+    if args[1].lower().endswith(".kmz"):
+        writeKMZ(args[1],placemarks,index,int(options.get("leaf-size",1000)),pool,sinks)
+    else:
+        writeKML(args[1],placemarks,index,pool,sinks)
+
+    for sink in sinks:
+        sink.close()
+
+    if not journal == None:
+        journal.finish()
+
+def searchImages(bbox,regions,rs,options,br,journal=None):
+    '''Searches the NASA site for the images in the predefined regions, or
+if they are None within bbox, as a grid of tiles with the --tile option.
+Only the images within rs (a ShapeFilter) are kept if it is given.
+Opening the search form and submitting it are retried like the pages of
+results after them, see Scheduler.
+
+Returns: generator of {Mission, Roll, Frame, Latitude, Longitude, Page}'''
+    pagethreads = int(options.get("page-threads",4))
+    retries = int(options.get("retries",4))
+
+    if "tile" in options and regions == None:
+        return getTiledImages(bbox,rs,float(options["tile"]),int(options.get("tile-pages",5)),pagethreads,journal,retries)
+
+    #the search has cookies of its own, so searches made at the same time
+    #by -d can't be mixed up
+    jar = mechanize.CookieJar()
+    br.set_cookiejar(jar)
+
+    #the first page is read in full so a failure part way through it is retried too
+    def submit():
+        if regions == None:
+            response = getBBoxResults(bbox,br)
+        else:
+            response = getLocationResults(regions,br)
+        response.read()
+        response.seek(0)
+        return response
+
+    response = Scheduler(1,0,retries).call(submit)
+    return getImages(response,br,rs,pagethreads,journal,retries,jar)
+
+def searchIndex(index,bbox,rs,photofilter=None):
+    '''Answers a query from index (a PhotoIndex) instead of the NASA site,
+see PhotoIndex.query, keeping only the photographs accepted by
+photofilter (a PhotoFilter) if it is given
+
+Returns: generator of (image, attr, error)'''
+    if photofilter == None:
+        return index.query(bbox,None,None,rs)
+    placemarks = index.query(bbox,photofilter.start,photofilter.end,rs)
+    return itertools.ifilter(lambda placemark: photofilter.accepts(placemark[1]),placemarks)
+
+def importShapes(ogr=True):
+    '''Imports shapely and numpy, and osgeo unless ogr is False
+they are only imported once a shape is used, which allows the other
+queries to be independent of these modules'''
+    import shapely as shp
+    import shapely.geometry
+    import numpy as np
+    from shapely.wkb import loads as ld
+    global shapely
+    global numpy
+    global loads
+    shapely = shp
+    numpy = np
+    loads = ld
+
+    if ogr:
+        import osgeo.ogr as osr
+        global osgeo
+        osgeo = osr
 
 def getShape(shapefile):
-    '''Reads the shapefile and computes the bounding box.
-The bounding box is needed to narrow the search performed on the NASA site'''
+    '''Reads every feature of the shapefile
+
+Returns: list of geometries'''
 
     #load the shapefile
     driver = osgeo.GetDriverByName('ESRI Shapefile')
@@ -125,211 +601,1535 @@ The bounding box is needed to narrow the search performed on the NASA site'''
         sys.exit()
 
     layer = dataset.GetLayer()
-    
-    #Only the first feature is used
+
+    geometries = []
     for index in xrange(layer.GetFeatureCount()):
         feature = layer.GetFeature(index)
         geometry = feature.GetGeometryRef()
-        newshp = loads(geometry.ExportToWkb())
-        return newshp
+        geometries += [loads(geometry.ExportToWkb())]
 
-def getBBoxResults(bbox,br):
-    '''Fills out the search form using a bounding box to narrow the results
+    if len(geometries) == 0:
+        print "Empty Shapefile: "+shapefile
+        sys.exit()
 
-Returns: search results response'''
-    br.open("http://eol.jsc.nasa.gov/sseop/technical.htm")
+    return geometries
 
-    br.select_form(name="sqlform")
-    br["minlat"] = repr(float(bbox[1]))
-    br["maxlat"] = repr(float(bbox[3]))
-    br["minlon"] = repr(float(bbox[0]))
-    br["maxlon"] = repr(float(bbox[2]))
-    br["imagesize"] = ["any"]
-    response = br.submit()
+def geojsonShapes(doc):
+    '''Reads the polygons of a GeoJSON geometry, Feature or FeatureCollection
 
-    return response
+Returns: list of geometries'''
+    if not isinstance(doc,dict):
+        raise ValueError("not a GeoJSON object")
+    if doc.get("type") == "FeatureCollection":
+        return sum([geojsonShapes(feature) for feature in doc.get("features",[])],[])
+    if doc.get("type") == "Feature":
+        return geojsonShapes(doc.get("geometry"))
+    if not doc.get("type") in ("Polygon","MultiPolygon"):
+        raise ValueError("not a Polygon or MultiPolygon: " + repr(doc.get("type")))
+    return [shapely.geometry.shape(doc)]
 
-def getLocationResults(locations,br):
-    '''Fills out the search form using predefined regions to narrow the results
+class ShapeFilter(object):
+    '''Tests batches of points against the polygons read by getShape
 
-Returns: search results response'''
-    br.open("http://eol.jsc.nasa.gov/sseop/technical.htm")
+Multipolygons are split into their polygons and each polygon is prepared
+for repeated tests. Points are first masked against the bounding box of
+each polygon so only those that could be inside it are tested exactly.
+bounds covers every polygon and is used to narrow the search performed
+on the NASA site.'''
+
+    def __init__(self,geometries):
+        from shapely.prepared import prep
+
+        self.polygons = []
+        for geometry in geometries:
+            for polygon in getattr(geometry,"geoms",[geometry]):
+                self.polygons += [(polygon.bounds,prep(polygon))]
 
+        minx,miny,maxx,maxy = zip(*[bounds for bounds,polygon in self.polygons])
+        self.bounds = (min(minx),min(miny),max(maxx),max(maxy))
+
+        #newer versions of shapely can test a whole array of points at once
+        try:
+            from shapely.vectorized import contains
+            self.vectorized = contains
+        except ImportError:
+            self.vectorized = None
+
+    def contains(self,lons,lats):
+        '''Returns: array of whether each point (lons[i], lats[i]) is in any polygon'''
+        lons = numpy.asarray(lons,dtype=float)
+        lats = numpy.asarray(lats,dtype=float)
+        inside = numpy.zeros(len(lons),dtype=bool)
+
+        for (minx,miny,maxx,maxy),polygon in self.polygons:
+            candidates = numpy.nonzero(~inside & (lons >= minx) & (lons <= maxx) & (lats >= miny) & (lats <= maxy))[0]
+            if len(candidates) == 0:
+                continue
+
+            if not self.vectorized == None:
+                inside[candidates] = self.vectorized(polygon,lons[candidates],lats[candidates])
+            else:
+                for i in candidates:
+                    inside[i] = polygon.contains(shapely.geometry.Point(lons[i],lats[i]))
+
+        return inside
+
+    def intersects(self,bounds):
+        '''Returns: whether the box bounds (minx, miny, maxx, maxy) meets any polygon'''
+        box = shapely.geometry.box(*bounds)
+        for (minx,miny,maxx,maxy),polygon in self.polygons:
+            if minx <= bounds[2] and maxx >= bounds[0] and miny <= bounds[3] and maxy >= bounds[1] and polygon.intersects(box):
+                return True
+        return False
+
+def openSearchForm(br):
+    '''Selects the search form of technical.htm in br. The page is only
+downloaded the first time, later searches reuse the copy kept in formpage'''
+    global formpage
+    if formpage == None:
+        formpage = br.open(siteurl + "/sseop/technical.htm").read()
+    else:
+        br.set_response(mechanize.make_response(formpage,[("Content-Type","text/html")],
+                                                siteurl + "/sseop/technical.htm",200,"OK"))
     br.select_form(name="sqlform")
 
-    br["geoncb"] = ['on']
-    br["geon"] = locations
+class PhotoFilter(object):
+    '''Keeps only the photographs matching every filter given
+
+start and end (YYYYMMDD) limit the acquisition date, missions and tilts
+are lists of the missions and camera tilts allowed, camera and lens are
+text found in the camera and lens names, and sun and altitude are
+(minimum, maximum) sun elevations in degrees and spacecraft altitudes in
+nautical miles, either of which may be None.
+
+acceptsRow tests the columns of the search results so rows can be dropped
+as they are parsed, accepts tests the placemark attributes.'''
+
+    def __init__(self,start=None,end=None,missions=None,tilts=None,camera=None,lens=None,
+                 sun=(None,None),altitude=(None,None)):
+        self.start = start
+        self.end = end
+        self.missions = missions and set(mission.upper() for mission in missions)
+        self.tilts = tilts and set(tilt.upper() for tilt in tilts)
+        self.camera = camera and camera.lower()
+        self.lens = lens and lens.lower()
+        self.sun = sun
+        self.altitude = altitude
+
+    def acceptsDate(self,date):
+        return (not self.start or date >= self.start) and (not self.end or date <= self.end)
+
+    def acceptsRow(self,imgdc):
+        '''Returns: False if the row of search results can't match, True if it may'''
+        if self.missions and not imgdc["Mission"].upper() in self.missions:
+            return False
+        return not imgdc.get("Date") or self.acceptsDate(imgdc["Date"])
+
+    def accepts(self,attr):
+        '''Returns: whether the placemark attributes match every filter'''
+        if self.missions and not attr["MRF"].split("-")[0].upper() in self.missions:
+            return False
+        if not self.acceptsDate(attr["YYYYMMDD"]):
+            return False
+        if self.tilts and not attr["Camera Tilt"].strip().upper() in self.tilts:
+            return False
+        if self.camera and not self.camera in attr["Camera"].lower():
+            return False
+        if self.lens and not self.lens in attr["Camera Lens"].lower():
+            return False
+
+        for (minimum,maximum),name in ((self.sun,"Sun Elevation"),(self.altitude,"Spacecraft Altitude")):
+            if minimum == None and maximum == None:
+                continue
+            try:
+                value = float(attr[name])
+            except ValueError:
+                return False
+            if (not minimum == None and value < minimum) or (not maximum == None and value > maximum):
+                return False
+
+        return True
+
+def photoFilter(options):
+    '''Returns: the PhotoFilter chosen by the command line options, or None if there are no filters
+
+Dates may be written as YYYYMMDD, YYYY-MM-DD or YYYY/MM/DD. A ValueError
+naming the option is raised if a date or number doesn't parse.'''
+    filters = ["from","to","mission","tilt","camera","lens","sun-min","sun-max","altitude-min","altitude-max"]
+    if not any(name in options for name in filters):
+        return None
+
+    def text(name):
+        if options.get(name) == True:
+            raise ValueError(name + " needs a value")
+        return options.get(name)
+
+    def date(name):
+        value = text(name)
+        if value == None:
+            return None
+        found = datefinder.match(value)
+        try:
+            if found == None or not found.end(0) == len(value):
+                raise ValueError
+            time.strptime("".join(found.groups()),"%Y%m%d")
+        except ValueError:
+            raise ValueError(name + " should be a date, YYYYMMDD: " + value)
+        return "".join(found.groups())
+
+    def number(name):
+        value = text(name)
+        if value == None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(name + " should be a number: " + value)
+
+    def listed(name):
+        value = text(name)
+        return value and value.split(",")
+
+    return PhotoFilter(date("from"),date("to"),listed("mission"),listed("tilt"),
+                       text("camera"),text("lens"),
+                       (number("sun-min"),number("sun-max")),(number("altitude-min"),number("altitude-max")))
+
+def getBBoxResults(bbox,br):
+    '''Fills out the search form using a bounding box to narrow the results
+
+Returns: search results response'''
+    with metrics.timed("form submit"):
+        openSearchForm(br)
+        br["minlat"] = repr(float(bbox[1]))
+        br["maxlat"] = repr(float(bbox[3]))
+        br["minlon"] = repr(float(bbox[0]))
+        br["maxlon"] = repr(float(bbox[2]))
+        br["imagesize"] = ["any"]
+        response = br.submit()
 
-    br["imagesize"] = ["any"]
-    response = br.submit()
     return response
 
-def getImages(response,br,shape=None):
-    '''Parses search results
+def getLocationResults(locations,br):
+    '''Fills out the search form using predefined regions to narrow the results
 
-Returns: list of [Mission, Roll, Frame]'''
+Returns: search results response'''
+    with metrics.timed("form submit"):
+        openSearchForm(br)
 
-    doc =  response.read()
+        br["geoncb"] = ['on']
+        br["geon"] = locations
 
-    #extract the number of pages of results
-    pages =  pagefinder.search(doc).group()
-    pages = pages[pages.find("of")+6:]
-    pages = pages[:pages.find("<")]
-    pages = int(pages)
+        br["imagesize"] = ["any"]
+        response = br.submit()
+    return response
 
-    curpage = 1
+def fetchPages(br,pages,threads=4,retries=4,jar=None):
+    '''Fetches the result pages numbered in pages concurrently
 
-    images = []
+The requests are made by submitting the GoToPage form of the first page
+of results, which br must still be on. They are replayed by independent
+browser sessions, one per thread, sharing jar, the cookies of the search
+br made, and retried if they fail, see Scheduler.
 
-    print "Processing " + repr(pages) + " pages of results"
+Returns: generator of page html, in page order'''
+    requests = []
+    for page in pages:
+        br.select_form("GoToPage")
+        br["page"] = repr(page)
+        requests += [br.click()]
 
-    #process each page of results
-    while curpage<=pages:
-        sys.stdout.write(repr(curpage)+" ")
-        sys.stdout.flush()
+    local = threading.local()
+    scheduler = Scheduler(threads,0,retries)
 
-        if doc == None:
-            doc = response.read()
+    def openPage(request):
+        return local.br.open(request).read()
 
-        #trim the start and end of the page surrounding the table to make finding results easier
-        doc = doc[startfinder.search(doc).end(0):]
+    def fetch(request):
+        if not hasattr(local,"br"):
+            local.br = newBrowser(jar)
+        with metrics.timed("page fetch"):
+            doc = scheduler.call(openPage,request)
+        metrics.count("page bytes",len(doc))
+        return doc
 
-        doc = doc[:endfinder.search(doc).start(0)]
-        
-        #cut out the column headers
-        loc = trfinder.search(doc).start(0)
-        img = doc[:loc]
-        doc = doc[loc+5:]
-        loc = trfinder.search(doc).start(0)
+    return orderedMap(fetch,requests,threads)
 
-        #process each item in the table
-        while True:
-            img = doc[:loc]
-            doc = doc[loc+5:]
+def getImages(response,br,shape=None,threads=4,journal=None,retries=4,jar=None):
+    '''Parses search results, the pages after the first are fetched
+concurrently by fetchPages using threads browser sessions sharing jar,
+the cookies of the search.
+If shape (a ShapeFilter) is given only images within it are kept.
+Pages found in journal are not fetched again, those that are parsed
+are recorded in journal.
 
-            try:
-                loc = trfinder.search(doc).start(0)
-            except:
-                break
+Returns: generator of {Mission, Roll, Frame, Latitude, Longitude, Page}'''
 
-            #extract the mission number
-            imgdc = {}
-            loc2 = topfinder.search(img)
-            imgdc["Mission"] = img[loc2.start(0)+17:loc2.end(0)-5].replace(" ","")
-            img = img[loc2.end(0):]
+    with metrics.timed("page fetch"):
+        doc =  response.read()
+    metrics.count("page bytes",len(doc))
 
-            #extract the roll number
-            loc2 = topfinder.search(img)
-            imgdc["Roll"] = img[loc2.start(0)+17:loc2.end(0)-5].replace(" ","")
-            img = img[loc2.end(0):]
+    pages = pageCount(doc)
 
-            #extract the frame number
-            loc2 = targetfinder.search(img)
-            imgdc["Frame"] = img[loc2.start(0)+16:loc2.end(0)-9].replace(" ","")
+    print "Processing " + repr(pages) + " pages of results"
 
-            imgdc["Page"] = curpage
+    done = {}
+    if not journal == None:
+        done = journal.pages
 
-            #If appropriate, remove results that don't fall within the geometry
-            #defined by the shapefile
-            if not shape == None:
+    docs = fetchPages(br,[page for page in xrange(2,pages+1) if not page in done],threads,retries,jar)
 
-                img = img[loc2.end(0):]
-                img = img[tdfinder.search(img).end(0):]
-                img = img[tdfinder.search(img).end(0):]
-
-                #extract latitude
-                loc2 = topfinder.search(img)
-                lat = img[loc2.start(0)+17:loc2.end(0)-5]
-                img = img[loc2.end(0):]
-                
-                #extract longitude
-                loc2 = topfinder.search(img)
-                lon = img[loc2.start(0)+17:loc2.end(0)-5]
-                img = img[loc2.end(0):]
-
-                
-                #if the image isn't in the region, don't include it in the results
-                if not(lat == "") and not(lon == "") and shape.contains(shapely.geometry.Point(float(lon),float(lat))):
-                    #print lat,lon
-                    images += [imgdc]
+    #process each page of results
+    try:
+        for curpage in xrange(1,pages+1):
+            sys.stdout.write(repr(curpage)+" ")
+            sys.stdout.flush()
 
+            if curpage in done:
+                rows = done[curpage]
             else:
-                images += [imgdc]
+                if curpage > 1:
+                    doc = docs.next()
+                rows = parsePage(doc,curpage,shape)
+                if not journal == None:
+                    journal.addPage(curpage,rows)
+
+            for imgdc in rows:
+                yield imgdc
+    finally:
+        docs.close()
+
+def pageCount(doc):
+    '''Returns: the number of pages of results reported by the first page,
+0 if the search found nothing'''
+    found = pagefinder.search(doc)
+    if found == None:
+        return 0
+    pages = found.group()
+    pages = pages[pages.find("of")+6:]
+    pages = pages[:pages.find("<")]
+    return int(pages)
+
+def makeTiles(bbox,size):
+    '''Divides bbox (minlon, minlat, maxlon, maxlat) into a grid of tiles
+no more than size degrees across
+
+Returns: list of tiles (minlon, minlat, maxlon, maxlat)'''
+    minlon,minlat,maxlon,maxlat = [float(value) for value in bbox]
+    columns = max(1,int(-(-(maxlon-minlon)//size)))
+    rows = max(1,int(-(-(maxlat-minlat)//size)))
+    width = (maxlon-minlon)/columns
+    height = (maxlat-minlat)/rows
+
+    tiles = []
+    for row in xrange(rows):
+        for column in xrange(columns):
+            tiles += [(minlon+column*width,minlat+row*height,
+                       maxlon if column == columns-1 else minlon+(column+1)*width,
+                       maxlat if row == rows-1 else minlat+(row+1)*height)]
+    return tiles
+
+def getTiledImages(bbox,shape=None,size=10.0,maxpages=5,threads=4,journal=None,retries=4):
+    '''Searches bbox as a grid of tiles no more than size degrees across,
+threads tiles at a time each with its own browser session and cookies,
+so the pages of one tile are never those of another. A tile with
+more than maxpages pages of results is split into four smaller tiles
+which are searched in turn, so each search stays small however large
+bbox is. Tiles outside shape (a ShapeFilter) are not searched and only
+images within it are kept. Images on the edge of two tiles are only
+returned once. Tiles found in journal are not searched again, those that
+are completed are recorded in journal.
+
+Returns: generator of {Mission, Roll, Frame, Latitude, Longitude, Page}'''
+    local = threading.local()
+    scheduler = Scheduler(threads,0,retries)
+
+    done = {}
+    if not journal == None:
+        done = journal.pages
+
+    def submit(tile):
+        response = getBBoxResults(tile,local.br)
+        with metrics.timed("page fetch"):
+            return response.read()
+
+    def search(tile):
+        '''Returns: list of images, or list of smaller tiles to search instead'''
+        key = "%r,%r,%r,%r" % tile
+        if key in done:
+            return "images",done[key]
+
+        if not hasattr(local,"br"):
+            local.br = newBrowser()
+        jar = mechanize.CookieJar()
+        local.br.set_cookiejar(jar)
+        doc = scheduler.call(submit,tile)
+        metrics.count("page bytes",len(doc))
+
+        pages = pageCount(doc)
+        if pages > maxpages and tile[2]-tile[0] > mintile:
+            metrics.count("tiles split")
+            return "tiles",makeTiles(tile,(tile[2]-tile[0])/2)
+
+        images = parsePage(doc,1,shape)
+        for curpage,doc in enumerate(fetchPages(local.br,xrange(2,pages+1),1,retries,jar),2):
+            images += parsePage(doc,curpage,shape)
+
+        if not journal == None:
+            journal.addPage(key,images)
+        return "images",images
+
+    tiles = makeTiles(bbox,size)
+    seen = set()
+    while len(tiles) > 0:
+        if not shape == None:
+            tiles = [tile for tile in tiles if shape.intersects(tile)]
+        print "Searching " + repr(len(tiles)) + " tiles"
+        metrics.count("tiles",len(tiles))
+
+        split = []
+        searched = orderedMap(search,tiles,threads)
+        try:
+            for number,(kind,found) in enumerate(searched,1):
+                sys.stdout.write(repr(number)+" ")
+                sys.stdout.flush()
+
+                if kind == "tiles":
+                    split += found
+                    continue
+
+                for imgdc in found:
+                    key = mrfkey%imgdc
+                    if key in seen:
+                        metrics.count("duplicate images")
+                        continue
+                    seen.add(key)
+                    yield imgdc
+        finally:
+            searched.close()
+        print
+
+        tiles = split
+
+def parsePage(doc,curpage,shape=None):
+    '''Extracts the images from a page of search results,
+keeping only those within shape if it is given. A page without a table
+of results, as returned by a search that found nothing, has no images.
+
+Returns: list of {Mission, Roll, Frame, Date, Latitude, Longitude, Page}'''
+
+    with metrics.timed("row parse"):
+        #only search the table of results, skipping the column headers
+        start = startfinder.search(doc)
+        if start == None:
+            return []
+        start = start.end(0)
+        start = trfinder.search(doc,start).end(0)
+        end = endfinder.search(doc,start).start(0)
+
+        #extract every row of the table in one pass
+        rows = []
+        for row in rowfinder.finditer(doc,start,end):
+            imgdc = ImageRecord()
+            imgdc["Mission"] = row.group(1).replace(" ","")
+            imgdc["Roll"] = row.group(2).replace(" ","")
+            imgdc["Frame"] = row.group(3).replace(" ","")
+            date = datefinder.search(row.group(4))
+            imgdc["Date"] = "".join(date.groups()) if date else ""
+            imgdc["Latitude"] = row.group(5) or ""
+            imgdc["Longitude"] = row.group(6) or ""
+            imgdc["Page"] = curpage
+            rows += [imgdc]
+    metrics.count("rows",len(rows))
+
+    #If appropriate, remove results that don't fall within the geometry
+    #defined by the shapefile, testing the whole page at once
+    if not shape == None:
+        with metrics.timed("shape filter"):
+            located = [imgdc for imgdc in rows if not(imgdc["Latitude"] == "") and not(imgdc["Longitude"] == "")]
+            inside = shape.contains([float(imgdc["Longitude"]) for imgdc in located],
+                                    [float(imgdc["Latitude"]) for imgdc in located])
+            metrics.count("rows outside shape",len(rows)-sum(inside))
+            rows = [imgdc for imgdc,keep in zip(located,inside) if keep]
+
+    return rows
+
+def fetchPlacemark(url,cache=None,key=None):
+    '''Downloads and parses a placemark through the shared connection pool
+
+If cache holds an entry for key, however old, it is revalidated with
+If-None-Match/If-Modified-Since and reused when the server reports it
+unchanged. A newly downloaded placemark is stored in cache.
+
+Returns: the placemark attributes, or None if it couldn't be parsed'''
+    stale = None
+    headers = {}
+    if not cache == None:
+        stale = cache.stale(key)
+        if not stale == None:
+            if stale[1]:
+                headers["If-None-Match"] = stale[1]
+            if stale[2]:
+                headers["If-Modified-Since"] = stale[2]
+
+    status,headers,body = httppool.get(url,headers)
+
+    #a placemark that was fetched is kept even if the cache can't be written
+    try:
+        if status == 304 and not stale == None:
+            metrics.count("revalidated")
+            cache.renew(key)
+            return stale[0]
+        if not status == 200:
+            raise HTTPError(status)
+
+        metrics.count("placemark bytes",len(body))
+        attr = parsePlacemarkText(body)
+        if not (cache == None or attr == None):
+            cache.put(key,attr,headers.get("etag"),headers.get("last-modified"))
+    except sqlite3.Error:
+        metrics.count("cache errors")
+        if status == 304:
+            return stale[0]
+    return attr
 
-        doc = None
-        curpage += 1
+def parsePlacemarkText(text):
+    '''Extracts the placemark metadata from a PhotoKML.pl document
 
-        #advance to the next page of results
-        if curpage <= pages:
-            br.select_form("GoToPage")
-            br["page"] = repr(curpage)
-            response = br.submit()
+Fields are found by their tags and labels wherever they are in the
+text rather than on fixed lines, so lines may be reordered, split or
+added without confusing the parser. Missing fields are left empty.
 
-    return images
+Returns: the placemark attributes, or None if text isn't a placemark'''
+    if not "<Placemark>" in text:
+        return
 
-def ParsePlacemark(url):
-    '''Extracts metadata necessary to build a placemark'''
-    plmrk = urllib2.urlopen(url)
+    #the first of each field counts, so they are stored last to first
+    found = {}
+    for tag,value,label,labelled in reversed(fieldfinder.findall(text)):
+        if tag:
+            found[tag] = value
+        else:
+            found[label] = labelled
+    get = found.get
+
+    #the source of the image is the first .JPG, quoted or not
+    img = ""
+    end = text.find(".JPG")
+    start = text.rfind("src=",0,end)
+    if end >= 0 and start >= 0:
+        img = text[start+4:end+4].lstrip("\"'")
+
+    #the time keeps the space before it, placeMaker expects it
+    acquired = get("Acquired","")
+    date = acquired[:acquired.find(" (")] if " (" in acquired else acquired
+    clock = acquired[acquired.find("DD), ")+4:acquired.find(" (HH")] if " (HH" in acquired else ""
+
+    altitude = get("Spacecraft Altitude","")
+    altitude = altitude[:altitude.find(" nau")] if " nau" in altitude else altitude
+
+    entry = get("Database Entry Page","")
+    entry = entry[entry.find("='")+2:entry.find("'>")] if "'>" in entry else ""
+
+    #in the order of the fields of PlacemarkRecord
+    return PlacemarkRecord.fromValues((
+        get("name",""),             #MRF
+        get("color",""),            #Color
+        "3000",                     #Elevation
+        "0",                        #Tilt
+        get("longitude",""),        #Longitude
+        get("latitude",""),         #Latitude
+        img,                        #IMG
+        get("Features",""),         #Features
+        date,                       #YYYYMMDD
+        clock,                      #HHMMSS
+        get("Camera Tilt",""),      #Camera Tilt
+        get("Camera Lens",""),      #Camera Lens
+        get("Camera",""),           #Camera
+        get("Sun Azimuth",""),      #Sun Azimuth
+        get("Sun Elevation",""),    #Sun Elevation
+        altitude,                   #Spacecraft Altitude
+        entry))                     #DB Entry
+
+class Metrics(object):
+    '''Timings and counters of the stages of a run
+
+Each piece of work is timed by wrapping it in a with timed(stage)
+statement, which keeps the count, total and maximum time of the stage and
+a histogram of its latencies in power of two millisecond buckets.
+count adds to a named counter, such as bytes transferred or errors.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def timed(self,stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage,time.time()-start)
+
+    def record(self,stage,seconds):
+        bucket = 1
+        while bucket < seconds*1000:
+            bucket *= 2
+
+        with self.lock:
+            totals = self.stages.setdefault(stage,{"count":0,"seconds":0.0,"max":0.0,"histogram":{}})
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            totals["max"] = max(totals["max"],seconds)
+            totals["histogram"][bucket] = totals["histogram"].get(bucket,0) + 1
+
+    def count(self,name,amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0) + amount
+
+    def report(self):
+        '''Returns: the timings and counters so far as a json-ready dict'''
+        with self.lock:
+            stages = {}
+            for stage,totals in self.stages.iteritems():
+                stages[stage] = {"count":totals["count"],
+                                 "seconds":totals["seconds"],
+                                 "mean":totals["seconds"]/totals["count"],
+                                 "max":totals["max"],
+                                 "histogram_ms":dict(("<=%d" % bucket,n) for bucket,n in totals["histogram"].iteritems())}
+            return {"elapsed":time.time()-self.started,"stages":stages,"counters":dict(self.counters)}
+
+    def write(self,fileName):
+        '''Writes the report to fileName, replacing it whole so readers never see part of one
+
+The periodic writes of emit and the final one take turns, as they share
+the temporary file.'''
+        temp = fileName + ".tmp"
+        with self.writing:
+            out = open(temp,"w")
+            json.dump(self.report(),out,indent=1,sort_keys=True)
+            out.close()
+            os.rename(temp,fileName)
+
+    def emit(self,fileName,interval):
+        '''Rewrites the report to fileName every interval seconds until the program ends'''
+        def run():
+            while True:
+                time.sleep(interval)
+                self.write(fileName)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+#records every stage of the run, see --metrics
+metrics = Metrics()
+
+class Record(object):
+    '''Compact record of named fields, used in place of a dict for the rows
+of search results and the attributes of placemarks
+
+Each field is kept in a slot rather than a per-record dict, and the
+values of the fields listed in interned, which repeat from record to
+record, are only stored once.
+Fields are read and set like the items of a dict, so records work with
+% formatting such as mrfkey%image. See recordType.'''
+
+    __slots__ = ()
+    fields = ()
+    slots = {}
+    interned = ()
+    internflags = ()
+
+    def __init__(self,values={}):
+        for key,value in values.items():
+            self[key] = value
+
+    @classmethod
+    def fromValues(cls,values):
+        '''Returns: a record of values, given in the order of fields'''
+        record = cls()
+        for slot,value,interned in zip(cls.__slots__,values,cls.internflags):
+            if interned and type(value) == str:
+                value = intern(value)
+            setattr(record,slot,value)
+        return record
+
+    def __getitem__(self,key):
+        try:
+            return getattr(self,self.slots[key])
+        except (KeyError,AttributeError):
+            raise KeyError(key)
 
-    lines = []
+    def __setitem__(self,key,value):
+        if key in self.interned and type(value) == str:
+            value = intern(value)
+        setattr(self,self.slots[key],value)
 
-    for line in plmrk:
-        lines += [line]
+    def __contains__(self,key):
+        return key in self.slots and hasattr(self,self.slots[key])
 
-    if not "<Placemark>" in lines[0]:
-        return
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [field for field in self.fields if field in self]
+
+    def items(self):
+        return [(field,self[field]) for field in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __reduce__(self):
+        return (type(self),(dict(self.items()),))
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + repr(dict(self.items())) + ")"
+
+def recordType(name,fields,interned=()):
+    '''Returns: a Record class with a slot for each of fields'''
+    slots = dict((field,re.sub("\W","_",field)) for field in fields)
+    return type(name,(Record,),{"__slots__":tuple(slots[field] for field in fields),"fields":tuple(fields),
+                                "slots":slots,"interned":frozenset(interned),
+                                "internflags":tuple(field in interned for field in fields)})
+
+#a row of search results, see parsePage
+ImageRecord = recordType("ImageRecord",["Mission","Roll","Frame","Date","Latitude","Longitude","Page"],
+                         ["Mission","Roll","Date"])
+
+#the attributes of a placemark, see parsePlacemarkText
+PlacemarkRecord = recordType("PlacemarkRecord",["MRF","Color","Elevation","Tilt","Longitude","Latitude","IMG",
+                                                "Features","YYYYMMDD","HHMMSS","Camera Tilt","Camera Lens",
+                                                "Camera","Sun Azimuth","Sun Elevation","Spacecraft Altitude",
+                                                "DB Entry"],
+                             ["Color","Elevation","Tilt","Features","YYYYMMDD","Camera Tilt","Camera Lens",
+                              "Camera","Sun Azimuth","Sun Elevation","Spacecraft Altitude"])
+
+def sizeOf(value):
+    '''Returns: roughly how many bytes of memory value, a record or list of records, takes up'''
+    if isinstance(value,list):
+        return sys.getsizeof(value) + sum(sizeOf(item) for item in value)
+    return sys.getsizeof(value) + sum(sys.getsizeof(item) for key,item in value.iteritems())
+
+class RecordStore(object):
+    '''Dictionary of records, or lists of records, kept in memory until they
+take up more than budget bytes (0 for no limit). Records stored after
+that are spilled to a temporary SQLite database, so very large runs only
+keep budget bytes of them in memory.'''
+
+    def __init__(self,budget=0):
+        self.budget = budget
+        self.size = 0
+        self.records = {}
+        self.spilled = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __setitem__(self,key,value):
+        with self.lock:
+            if key in self.records:
+                self.size -= sizeOf(self.records.pop(key))
+            elif self.spilled == None or self.spilled.execute("DELETE FROM records WHERE key=?",(str(key),)).rowcount == 0:
+                self.count += 1
+
+            size = sizeOf(value)
+            if self.budget == 0 or self.size+size <= self.budget:
+                self.records[key] = value
+                self.size += size
+                return
+
+            #an empty file name makes SQLite create a temporary database
+            #that is removed when it is closed
+            if self.spilled == None:
+                self.spilled = sqlite3.connect("",check_same_thread=False)
+                self.spilled.execute("CREATE TABLE records (key TEXT PRIMARY KEY, value BLOB)")
+                metrics.count("stores spilled")
+            self.spilled.execute("INSERT OR REPLACE INTO records VALUES (?,?)",
+                                 (str(key),buffer(cPickle.dumps(value,2))))
+            metrics.count("records spilled")
+
+    def get(self,key,default=None):
+        with self.lock:
+            if key in self.records:
+                return self.records[key]
+            if self.spilled == None:
+                return default
+            row = self.spilled.execute("SELECT value FROM records WHERE key=?",(str(key),)).fetchone()
+        if row == None:
+            return default
+        return cPickle.loads(str(row[0]))
+
+    def __getitem__(self,key):
+        value = self.get(key)
+        if value == None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self,key):
+        return not self.get(key) == None
+
+    def __len__(self):
+        return self.count
+
+def dumpRecord(record):
+    '''Returns: record as json, strings are read as latin-1 so any bytes survive the round trip'''
+    return json.dumps(record,encoding="latin-1",default=dict)
+
+def loadRecord(text):
+    '''Returns: the record saved by dumpRecord'''
+    return decodeRecord(json.loads(text))
+
+def decodeRecord(record):
+    '''Returns: record with the unicode strings json produces turned back into their original bytes'''
+    return dict((str(k),v.encode("latin-1") if isinstance(v,unicode) else v) for k,v in record.iteritems())
+
+def openShared(db):
+    '''Switches db, an SQLite database that other runs may be using at the
+same time, to write-ahead logging so they can keep reading it while one
+of them writes, where the file system supports it'''
+    try:
+        db.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.Error:
+        pass
+
+class PlacemarkCache(object):
+    '''Persistent cache of the attributes returned by fetchPlacemark,
+stored in an SQLite database and keyed by Mission-Roll-Frame
+
+Entries older than ttl seconds are treated as missing (0 keeps them
+forever) and the least recently used entries are evicted once there are
+more than size of them (0 for no limit). With refresh set every lookup
+misses, so each placemark is fetched again and the cache updated.
+The ETag and Last-Modified headers of each placemark are kept so that
+stale entries can be revalidated instead of downloaded again.
+
+Each write is committed straight away so other runs sharing the cache
+are never locked out for long, and wait up to dbtimeout seconds for each
+other. Lookups don't write, the times entries were last used are
+gathered in touched and written with the next write.'''
+
+    def __init__(self,fileName,ttl=0,size=0,refresh=False):
+        self.ttl = ttl
+        self.size = size
+        self.refresh = refresh
+        self.writes = 0
+        self.touched = {}
+        self.lock = threading.Lock()
+
+        #the cache is shared by the fetch threads, access is serialized by the lock
+        self.db = sqlite3.connect(fileName,dbtimeout,check_same_thread=False)
+        openShared(self.db)
+        self.db.execute("CREATE TABLE IF NOT EXISTS placemarks (mrf TEXT PRIMARY KEY, attr TEXT, fetched REAL, used REAL, etag TEXT, modified TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS placemarks_used ON placemarks (used)")
+
+        #caches made before revalidation was supported lack its columns
+        columns = [column[1] for column in self.db.execute("PRAGMA table_info(placemarks)")]
+        for column in ("etag","modified"):
+            if not column in columns:
+                self.db.execute("ALTER TABLE placemarks ADD COLUMN %s TEXT" % column)
+
+    def get(self,key):
+        '''Returns: the cached attributes for key, or None'''
+        if self.refresh:
+            return None
+
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT attr, fetched FROM placemarks WHERE mrf=?",(key,)).fetchone()
+            if row == None or (self.ttl and now-row[1] > self.ttl):
+                return None
+            self.touched[key] = now
+
+        return PlacemarkRecord(loadRecord(row[0]))
+
+    def stored(self,key):
+        '''Returns: the attributes cached for key however old, even without
+validators, or None'''
+        with self.lock:
+            row = self.db.execute("SELECT attr FROM placemarks WHERE mrf=?",(key,)).fetchone()
+        if row == None:
+            return None
+        return PlacemarkRecord(loadRecord(row[0]))
+
+    def stale(self,key):
+        '''Returns: (attributes, ETag, Last-Modified) cached for key however old, or None'''
+        with self.lock:
+            row = self.db.execute("SELECT attr, etag, modified FROM placemarks WHERE mrf=?",(key,)).fetchone()
+        if row == None or (row[1] == None and row[2] == None):
+            return None
+        return PlacemarkRecord(loadRecord(row[0])),row[1],row[2]
+
+    def renew(self,key):
+        '''Marks the entry for key as fetched now, after it was revalidated'''
+        now = time.time()
+        with self.lock:
+            self.db.execute("UPDATE placemarks SET fetched=?, used=? WHERE mrf=?",(now,now,key))
+            self.commit()
+
+    def put(self,key,attr,etag=None,modified=None):
+        '''Stores the attributes for key with the validators of the response they came from'''
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO placemarks (mrf, attr, fetched, used, etag, modified) VALUES (?,?,?,?,?,?)",
+                            (key,dumpRecord(attr),now,now,etag,modified))
+            self.writes += 1
+            self.commit(self.writes%100 == 0)
+
+    def commit(self,evict=False):
+        '''Writes the times of the entries used since the last commit, then
+evicts if evict is set, so entries just used are kept, and commits'''
+        try:
+            touched = self.touched
+            self.touched = {}
+            self.db.executemany("UPDATE placemarks SET used=? WHERE mrf=?",[(used,key) for key,used in touched.iteritems()])
+            if evict:
+                self.evict()
+            self.db.commit()
+        except sqlite3.Error:
+            #give up the write lock rather than keep other runs waiting
+            self.db.rollback()
+            raise
+
+    def evict(self):
+        '''Removes the least recently used entries beyond the size limit'''
+        if self.size:
+            self.db.execute("DELETE FROM placemarks WHERE mrf IN (SELECT mrf FROM placemarks ORDER BY used DESC LIMIT -1 OFFSET ?)",(self.size,))
+
+    def close(self):
+        with self.lock:
+            try:
+                self.commit(True)
+            except sqlite3.Error, e:
+                print "Couldn't update the placemark cache: " + str(e)
+            self.db.close()
+
+class PhotoIndex(object):
+    '''Local index of harvested photographs, for answering queries offline
+
+Each row of search results and the placemark attributes fetched for it
+are stored in an SQLite database. Photographs are located through an
+R-tree on longitude/latitude (or a plain index if SQLite was built
+without R-tree support) and indexed by acquisition date and mission.
+
+Writes are committed in batches at least every commitinterval seconds,
+and whenever flush is called, so other runs sharing the index are never
+locked out for long. They wait up to dbtimeout seconds for each other.'''
+
+    def __init__(self,fileName):
+        self.committed = time.time()
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(fileName,dbtimeout,check_same_thread=False)
+        openShared(self.db)
+        self.db.execute("CREATE TABLE IF NOT EXISTS photos (id INTEGER PRIMARY KEY, mrf TEXT UNIQUE, mission TEXT, roll TEXT, frame TEXT, "
+                        "lat REAL, lon REAL, date TEXT, attr TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS photos_date ON photos (date)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS photos_mission ON photos (mission)")
 
-    attr = {}
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS photos_rtree USING rtree (id, minlon, maxlon, minlat, maxlat)")
+            self.rtree = True
+        except sqlite3.OperationalError:
+            self.db.execute("CREATE INDEX IF NOT EXISTS photos_location ON photos (lon, lat)")
+            self.rtree = False
+
+    def add(self,image,attr=None):
+        '''Records a row of search results and the placemark attributes fetched for it, if any'''
+        key = mrfkey%image
+        located = attr or image
+        try:
+            lat = float(located["Latitude"])
+            lon = float(located["Longitude"])
+        except (KeyError,ValueError):
+            lat = lon = None
+
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO photos (mrf, mission, roll, frame) VALUES (?,?,?,?)",
+                            (key,image["Mission"],image["Roll"],image["Frame"]))
+            if not attr == None:
+                self.db.execute("UPDATE photos SET date=?, attr=? WHERE mrf=?",(attr["YYYYMMDD"],dumpRecord(attr),key))
+            if not lat == None:
+                self.db.execute("UPDATE photos SET lat=?, lon=? WHERE mrf=?",(lat,lon,key))
+                if self.rtree:
+                    id = self.db.execute("SELECT id FROM photos WHERE mrf=?",(key,)).fetchone()[0]
+                    self.db.execute("INSERT OR REPLACE INTO photos_rtree VALUES (?,?,?,?,?)",(id,lon,lon,lat,lat))
+
+            if time.time()-self.committed >= commitinterval:
+                self.commit()
+
+    def commit(self):
+        try:
+            self.db.commit()
+        except sqlite3.Error:
+            #give up the write lock rather than keep other runs waiting
+            self.db.rollback()
+            raise
+        finally:
+            self.committed = time.time()
+
+    def flush(self):
+        '''Commits the photographs added so far'''
+        with self.lock:
+            self.commit()
+
+    def get(self,key):
+        '''Returns: the placemark attributes of key stored in the index, or None'''
+        with self.lock:
+            row = self.db.execute("SELECT attr FROM photos WHERE mrf=?",(key,)).fetchone()
+        if row == None or row[0] == None:
+            return None
+        return PlacemarkRecord(loadRecord(row[0]))
+
+    def query(self,bbox,start=None,end=None,shape=None):
+        '''Finds the photographs with placemark attributes in the index that lie
+within bbox (minlon, minlat, maxlon, maxlat) and shape (a ShapeFilter) if
+it is given, acquired between start and end (YYYYMMDD) if they are given
+
+Returns: generator of (image, attr, None) like fetchPlacemarks'''
+        minlon,minlat,maxlon,maxlat = [float(value) for value in bbox]
+
+        if self.rtree:
+            sql = ("SELECT p.mission, p.roll, p.frame, p.attr FROM photos p JOIN photos_rtree r ON p.id=r.id "
+                   "WHERE r.minlon>=? AND r.maxlon<=? AND r.minlat>=? AND r.maxlat<=? AND p.attr IS NOT NULL")
+        else:
+            sql = ("SELECT p.mission, p.roll, p.frame, p.attr FROM photos p "
+                   "WHERE p.lon>=? AND p.lon<=? AND p.lat>=? AND p.lat<=? AND p.attr IS NOT NULL")
+        params = [minlon,maxlon,minlat,maxlat]
 
-    attr["MRF"]                 = lines[2][lines[2].find("<name>")+6:lines[2].find("</name>")]
-    attr["Color"]               = lines[6][lines[6].find("<color>")+7:lines[6].find("</color")]
-    attr["Elevation"]           = "3000"
-    attr["Tilt"]                = "0"
-    attr["Longitude"]           = lines[15][lines[15].find("<longitude>")+11:lines[15].find("</longitude")]
-    attr["Latitude"]            = lines[16][lines[16].find("<latitude>")+10:lines[16].find("</latitude")]
-    attr["IMG"]                 = lines[20][lines[20].find("src=")+5:lines[20].find(".JPG")+4]
-    attr["Features"]            = lines[23][lines[23].find(": ")+2:lines[23].find("</P>")]
-    attr["YYYYMMDD"]            = lines[24][lines[24].find(": ")+2:lines[24].find(" (")]
-    attr["HHMMSS"]              = lines[24][lines[24].find("DD), ")+4:lines[24].find(" (HH")]
+        if start:
+            sql += " AND p.date>=?"
+            params += [start]
+        if end:
+            sql += " AND p.date<=?"
+            params += [end]
 
-    cline = lines[25]
+        with self.lock:
+            cursor = self.db.execute(sql + " ORDER BY p.id",params)
 
-    attr["Camera Tilt"]         = cline[cline.find(": ")+2:cline.find("&nbsp")]
-    cline = cline[cline.find(";")+1:]
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if len(rows) == 0:
+                break
 
-    attr["Camera Lens"]         = cline[cline.find(": ")+2:cline.find("&nbsp")]
-    cline = cline[cline.find(";")+1:]
+            found = []
+            for mission,roll,frame,attr in rows:
+                attr = PlacemarkRecord(loadRecord(attr))
+                image = ImageRecord({"Mission":str(mission),"Roll":str(roll),"Frame":str(frame),
+                                     "Latitude":attr["Latitude"],"Longitude":attr["Longitude"],"Page":0})
+                found += [(image,attr,None)]
 
-    attr["Camera"]              = cline[cline.find(": ")+2:cline.find("</P>")]
-    cline = cline[cline.find(";")+1:]
+            if not shape == None:
+                inside = shape.contains([float(attr["Longitude"]) for image,attr,error in found],
+                                        [float(attr["Latitude"]) for image,attr,error in found])
+                found = [placemark for placemark,keep in zip(found,inside) if keep]
+
+            for placemark in found:
+                yield placemark
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
+
+class PlacemarkStore(object):
+    '''Placemarks fetched during this run, kept in memory up to budget bytes
+(see RecordStore) and shared by the jobs of a batch. A placemark
+requested by several threads at once is only fetched by the first, the
+others wait for its result.'''
+
+    def __init__(self,budget=0):
+        self.placemarks = RecordStore(budget)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def fetch(self,key,function,*args):
+        '''Returns: the placemark attributes of key, fetched by function(*args) if they aren't stored'''
+        with self.lock:
+            attr = self.placemarks.get(key)
+            if not attr == None:
+                metrics.count("store hits")
+                return attr
+            fetching = self.pending.get(key)
+            if fetching == None:
+                self.pending[key] = threading.Event()
+
+        #wait for the thread already fetching key, and fetch it again
+        #if that failed
+        if not fetching == None:
+            fetching.wait()
+            attr = self.placemarks.get(key)
+            if not attr == None:
+                metrics.count("store hits")
+                return attr
+            return function(*args)
 
-    cline = lines[26]
-    attr["Sun Azimuth"]         = cline[cline.find(": ")+2:cline.find("&nbsp")]
-    cline = cline[cline.find(";")+1:]
+        try:
+            attr = function(*args)
+            if not attr == None:
+                self.placemarks[key] = attr
+            return attr
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+
+class Journal(object):
+    '''Checkpoint journal recording each completed page of search results
+and each fetched placemark, so an interrupted run can be resumed
+
+The journal is a file of json lines, the first of which records the
+query so that a journal is only resumed by the same query. With resume
+set an existing journal is read into pages and placemarks, keeping up to
+budget bytes of them in memory, half for each (see RecordStore),
+otherwise a new one is started.'''
+
+    def __init__(self,fileName,query,resume=False,budget=0):
+        self.fileName = fileName
+        self.pages = RecordStore((budget+1)//2)
+        self.placemarks = RecordStore((budget+1)//2)
+        self.lock = threading.Lock()
+
+        if resume and os.path.exists(fileName):
+            valid = 0
+            for number,line in enumerate(open(fileName)):
+                #the last line may have been cut short when the run died
+                try:
+                    if not line.endswith("\n"):
+                        break
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+
+                if number == 0 and not entry == {"query":query}:
+                    print "Journal " + fileName + " was made by a different query"
+                    sys.exit(2)
+                elif "page" in entry:
+                    self.pages[entry["page"]] = [ImageRecord(decodeRecord(row)) for row in entry["rows"]]
+                elif "placemark" in entry:
+                    self.placemarks[str(entry["placemark"])] = PlacemarkRecord(decodeRecord(entry["attr"]))
+                valid += len(line)
+
+            print "Resuming with " + repr(len(self.pages)) + " pages and " + repr(len(self.placemarks)) + " placemarks done"
+
+            self.file = open(fileName,"r+")
+            self.file.truncate(valid)
+            self.file.seek(valid)
+        else:
+            self.file = open(fileName,"w")
+            self.write({"query":query})
+
+    def write(self,entry):
+        with self.lock:
+            self.file.write(dumpRecord(entry)+"\n")
+            self.file.flush()
+
+    def addPage(self,page,rows):
+        self.write({"page":page,"rows":rows})
+
+    def addPlacemark(self,key,attr):
+        self.write({"placemark":key,"attr":attr})
+
+    def finish(self):
+        '''Removes the journal once the run has completed'''
+        self.file.close()
+        os.remove(self.fileName)
+
+class HTTPError(IOError):
+    '''Raised when a request is answered with an error status'''
+
+    def __init__(self,code):
+        IOError.__init__(self,"HTTP error %d" % code)
+        self.code = code
+
+class HTTPPool(object):
+    '''Keep-alive HTTP connections shared by every fetch thread
+
+A connection is taken from the idle ones kept for its host, or opened,
+for each request and returned afterwards unless the server closes it.
+Responses are requested gzip compressed. Redirects are followed, up to
+redirects of them for each request.'''
+
+    def __init__(self,idle=16,timeout=60,redirects=5):
+        self.connections = {}
+        self.idle = idle
+        self.timeout = timeout
+        self.redirects = redirects
+        self.lock = threading.Lock()
+
+    def acquire(self,scheme,host):
+        with self.lock:
+            connections = self.connections.get((scheme,host))
+            if connections:
+                return connections.pop(),True
+        metrics.count("http connections")
+        if scheme == "https":
+            return httplib.HTTPSConnection(host,timeout=self.timeout),False
+        return httplib.HTTPConnection(host,timeout=self.timeout),False
+
+    def release(self,scheme,host,connection):
+        with self.lock:
+            connections = self.connections.setdefault((scheme,host),[])
+            if len(connections) < self.idle:
+                connections += [connection]
+                return
+        connection.close()
+
+    def get(self,url,headers={}):
+        '''Requests url with the extra headers given, following redirects
+
+Returns: (status, dict of lower case response headers, decompressed body)'''
+        for hop in xrange(self.redirects+1):
+            status,found,body = self.request(url,headers)
+            if not (status in (301,302,303,307,308) and "location" in found):
+                break
+            url = urlparse.urljoin(url,found["location"])
+            metrics.count("redirects")
+        return status,found,body
 
-    attr["Sun Elevation"]       = cline[cline.find(": ")+2:cline.find("&nbsp")]
-    cline = cline[cline.find(";")+1:]
+    def request(self,url,headers={}):
+        '''Requests url with the extra headers given, without following redirects
 
-    attr["Spacecraft Altitude"] = cline[cline.find(": ")+2:cline.find(" nau")]
-    cline = cline[cline.find(";")+1:]
+Returns: (status, dict of lower case response headers, decompressed body)'''
+        parts = urlparse.urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        headers = dict(headers)
+        headers["Accept-Encoding"] = "gzip"
 
-    attr["DB Entry"]            = lines[27][lines[27].find("='")+2:lines[27].find("'>")]
+        while True:
+            connection,reused = self.acquire(parts.scheme,parts.netloc)
+            try:
+                connection.request("GET",path,headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (httplib.HTTPException,socket.error):
+                connection.close()
+                #the server may have closed an idle connection, try again on a new one
+                if not reused:
+                    raise
+                metrics.count("stale connections")
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(parts.scheme,parts.netloc,connection)
+
+        metrics.count("http bytes",len(body))
+        if response.getheader("content-encoding") == "gzip":
+            body = zlib.decompress(body,16+zlib.MAX_WBITS)
+
+        return response.status,dict(response.getheaders()),body
+
+#shared by every placemark request
+httppool = HTTPPool()
+
+class RateLimiter(object):
+    '''Spaces out calls to wait() so that no more than rate calls
+return per second. A rate of 0 disables the limit.'''
+
+    def __init__(self,rate):
+        self.interval = 1.0/rate if rate > 0 else 0
+        self.next = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now,self.next) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+class Scheduler(object):
+    '''Makes requests with retries and an adaptive limit on how many are in flight
+
+A request failing with a network error, a timeout or a 5xx/429 status is
+retried up to retries times, after a random delay of up to backoff
+seconds doubled for each attempt. The limit on requests in flight starts
+at maximum and grows by one for every limit requests answered no slower
+than twice the average (additive increase), it is halved whenever a
+request times out or the server reports an error or overload
+(multiplicative decrease). Requests are also spaced out by a RateLimiter.'''
+
+    def __init__(self,maximum,rate=0,retries=4,backoff=0.5):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.retries = retries
+        self.backoff = backoff
+        self.active = 0
+        self.average = None
+        self.limiter = RateLimiter(rate)
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self,latency=None,overloaded=False):
+        with self.condition:
+            self.active -= 1
+            if overloaded:
+                self.limit = max(1.0,self.limit/2)
+                metrics.count("concurrency decreases")
+            elif not latency == None:
+                if self.average == None:
+                    self.average = latency
+                self.average = 0.9*self.average + 0.1*latency
+                if latency <= 2*self.average:
+                    self.limit = min(self.maximum,self.limit + 1/self.limit)
+            self.condition.notify_all()
+
+    def call(self,function,*args):
+        '''Returns: function(*args), retrying transient failures'''
+        attempt = 0
+        while True:
+            self.acquire()
+            self.limiter.wait()
+            start = time.time()
+            try:
+                result = function(*args)
+            except Exception, e:
+                code = getattr(e,"code",None)
+                timeout = isinstance(e,socket.timeout) or isinstance(getattr(e,"reason",None),socket.timeout)
+                overloaded = timeout or (isinstance(code,int) and (code >= 500 or code == 429))
+                self.release(overloaded=overloaded)
+
+                #other client errors will fail again, and errors that aren't
+                #from the network are bugs or pages that couldn't be parsed
+                transient = overloaded or (code == None and isinstance(e,(IOError,httplib.HTTPException)))
+                if not transient or attempt >= self.retries:
+                    raise
+
+                attempt += 1
+                metrics.count("retries")
+                time.sleep(random.uniform(0,self.backoff*2**attempt))
+                continue
+
+            self.release(time.time()-start)
+            return result
+
+class MapResults(object):
+    '''The results of orderedMap, in order. Closing them, or dropping them
+before they have all been read, stops the threads behind them.'''
+
+    def __init__(self,results,stop):
+        self.results = results
+        self.stop = stop
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.results.next()
+
+    def close(self):
+        self.results.close()
+        self.stop()
+
+    def __del__(self):
+        self.close()
+
+def orderedMap(function,items,threads):
+    '''Applies function to each of items using a pool of worker threads
+
+The workers start right away. items may be a generator, it is consumed
+by a feeder thread so producing items overlaps with processing them.
+The feeder runs at most threads*4 items ahead of the oldest unfinished
+one. Exceptions raised by items or function are raised again here. Once
+the results are closed the feeder closes items and the workers skip the
+items left, see MapResults.
+
+Returns: MapResults of function(item), in the same order as items'''
+    work = Queue.Queue()
+    results = Queue.Queue()
+    window = threading.Semaphore(threads*4)
+    stopped = threading.Event()
+
+    def feed():
+        count = 0
+        try:
+            for item in items:
+                window.acquire()
+                if stopped.is_set():
+                    break
+                work.put((count,item))
+                count += 1
+            if stopped.is_set() and hasattr(items,"close"):
+                items.close()
+        except Exception:
+            results.put(("error",sys.exc_info()))
+        for i in xrange(threads):
+            work.put(None)
+        results.put(("done",count))
 
-    return attr
+    def process():
+        while True:
+            task = work.get()
+            if task == None:
+                return
+            if stopped.is_set():
+                continue
+            try:
+                results.put(("result",task[0],function(task[1])))
+            except Exception:
+                results.put(("error",sys.exc_info()))
+
+    workers = [threading.Thread(target=feed)] + [threading.Thread(target=process) for i in xrange(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    #wakes the feeder and waits for it to close items, so nothing it
+    #was reading from, such as a browser session, is still in use
+    def stop():
+        if stopped.is_set():
+            return
+        stopped.set()
+        window.release()
+        if not threading.current_thread() is workers[0]:
+            workers[0].join()
+
+    #hand the results back in their original order
+    def collect():
+        pending = {}
+        index = 0
+        total = None
+        try:
+            while total == None or index < total:
+                if index in pending:
+                    result = pending.pop(index)
+                    window.release()
+                    index += 1
+                    yield result
+                    continue
+
+                msg = results.get()
+                if msg[0] == "result":
+                    pending[msg[1]] = msg[2]
+                elif msg[0] == "done":
+                    total = msg[1]
+                else:
+                    raise msg[1][0],msg[1][1],msg[1][2]
+        finally:
+            stop()
+
+    return MapResults(collect(),stop)
+
+def filterRows(images,photofilter):
+    '''Returns: generator of the images accepted by photofilter.acceptsRow'''
+    try:
+        for imgdc in images:
+            if photofilter.acceptsRow(imgdc):
+                yield imgdc
+            else:
+                metrics.count("rows filtered")
+    finally:
+        if hasattr(images,"close"):
+            images.close()
+
+def fetchPlacemarks(images,threads=8,rate=0,cache=None,journal=None,retries=4,store=None,photofilter=None,index=None):
+    '''Fetches placemark metadata for each image using a pool of worker threads
+
+At most threads requests are in flight at once, fewer while the server
+struggles, and no more than rate requests are started per second (0 for
+no limit). Failed requests are retried, see Scheduler. Results are yielded
+in the same order as images, whichever request finishes first.
+Placemarks found in journal or cache (a PlacemarkCache) are not fetched
+again, expired cache entries are revalidated, see fetchPlacemark, and
+those that are fetched are recorded in journal. Placemarks are fetched
+through store (a PlacemarkStore) if it is given, so one already fetched
+or being fetched for another job is not requested again. Only the
+placemarks accepted by photofilter (a PhotoFilter) are returned, and those
+already known to fail it from an expired cache entry or index (a
+PhotoIndex) are not fetched at all.
+
+Returns: generator of (image, attr, error)'''
+    scheduler = Scheduler(threads,rate,retries)
+
+    def download(image):
+        with metrics.timed("placemark fetch"):
+            return scheduler.call(fetchPlacemark,placemarkurl%image,cache,mrfkey%image)
+
+    def known(key):
+        '''Returns: placemark attributes of key found in the cache however old, or the index'''
+        if not cache == None:
+            stored = cache.stored(key)
+            if not stored == None:
+                return stored
+        if not index == None:
+            return index.get(key)
+
+    def fetch(image):
+        attr = None
+        error = None
+        try:
+            if not journal == None:
+                attr = journal.placemarks.get(mrfkey%image)
+            if attr == None and not cache == None:
+                attr = cache.get(mrfkey%image)
+                if not attr == None:
+                    metrics.count("cache hits")
+            if attr == None and not photofilter == None:
+                previous = known(mrfkey%image)
+                if not (previous == None or photofilter.accepts(previous)):
+                    metrics.count("placemarks filtered before fetch")
+                    return None
+            if attr == None:
+                if store == None:
+                    attr = download(image)
+                else:
+                    attr = store.fetch(mrfkey%image,download,image)
+                if not (journal == None or attr == None):
+                    journal.addPlacemark(mrfkey%image,attr)
+        except Exception, e:
+            error = e
+            metrics.count("placemark errors")
+
+        if not (photofilter == None or attr == None or photofilter.accepts(attr)):
+            metrics.count("placemarks filtered")
+            return None
+        return image,attr,error
+
+    #closing the placemarks closes the map, stopping its threads
+    def fetched(results):
+        try:
+            for placemark in results:
+                if not placemark == None:
+                    yield placemark
+        finally:
+            results.close()
 
+    return fetched(orderedMap(fetch,images,threads))
 
-def placeMaker(attr):
+def placeMaker(attr,styleUrl="#sm_style"):
     '''Uses pyKML to produce a placemark for an image
     
 The use of pyKML isn't actually necessary,
 you could do just as well appending the placemarks from the NASA
 KML files into a single document, but the intention was to
-give an example usage of pyKML.'''
+give an example usage of pyKML.
+
+styleUrl refers to sm_style, see kmlStyles'''
     try:
         placemark = K.Placemark(
                         K.open(0),
                         K.name(attr['MRF']),
-                        K.styleUrl("#sm_style"),
+                        K.styleUrl(styleUrl),
                         K.Point(
                             K.altitudeMode('relativeToGround'),
                             K.coordinates(",".join([attr["Longitude"],attr["Latitude"],attr["Elevation"]]))
@@ -362,44 +2162,18 @@ give an example usage of pyKML.'''
         return None
     return placemark
 
-def writeKML(fileName,images):
-    '''Writes the search results out as a kml file containing placemarks'''
-    ct = 0
-    kmlfile = open(fileName,'w')
-    placemarks = []
-    
-    print "\nWriting " + repr(len(images)) + " images to kml"
-
-    #make a placemark for each image
-    for image in images:
-        attr = None
-        try:
-            attr = ParsePlacemark("http://eol.jsc.nasa.gov/scripts/sseop/PhotoKML.pl?photo=%(Mission)s-%(Roll)s-%(Frame)s"%image)
-        except Exception:
-            print "Failed to open URL<%(Page)s>: http://eol.jsc.nasa.gov/scripts/sseop/PhotoKML.pl?photo=%(Mission)s-%(Roll)s-%(Frame)s"%image
-            print Exception
-        if attr == None:
-            print "Error Parsing URL<%(Page)s>: http://eol.jsc.nasa.gov/scripts/sseop/PhotoKML.pl?photo=%(Mission)s-%(Roll)s-%(Frame)s"%image
-        else:
-            placemarks += [placeMaker(attr)]
-
-        ct += 1
-        if ct%10 == 0:
-            sys.stdout.write(".")
-            sys.stdout.flush()
-
-    #create the kml file
-    doc =  K.kml(
-                K.Document(
-                            K.Style(
-                                    K.LabelStyle(K.scale("0")),
-                                    K.IconStyle(
-                                        K.scale(1.0),
-                                        K.Icon(K.href("http://maps.google.com/mapfiles/kml/shapes/camera.png"))
-                                    ),
-                                    K.BalloonStyle(
-
-                                        K.text(
+def kmlStyles():
+    '''Returns: the sn_style, sh_style and sm_style definitions used by every placemark'''
+    return [
+            K.Style(
+                    K.LabelStyle(K.scale("0")),
+                    K.IconStyle(
+                        K.scale(1.0),
+                        K.Icon(K.href("http://maps.google.com/mapfiles/kml/shapes/camera.png"))
+                    ),
+                    K.BalloonStyle(
+
+                        K.text(
 """<![CDATA[<P><STRONG><FONT size=4>$[MRF]</FONT</STRONG></P><P><IMG alt="$[MRF] image" src="$[IMG]" align=top></P>
 
 <P>&nbsp;</P>
@@ -422,19 +2196,19 @@ def writeKML(fileName,images):
 
 <P align=center><FONT face=Arial>&nbsp;Image Science and Analysis Laboratory, NASA-Johnson Space Center. "The Gateway to Astronaut Photography of Earth." <BR><A href="http://eol.jsc.nasa.gov/"><IMG height=71 alt="Crew Earth Observations" src="http://eol.jsc.nasa.gov/images/CEO.jpg" width=82 align=left border=0></A> <A href="http://www.nasa.gov/" target=_blank><IMG height=71 alt="NASA meatball" src="http://eol.jsc.nasa.gov/images/NASA.jpg" width=82 align=right border=0></A> <!--{PS..3}--><!--{PS..4}--><!--{PS..6}--><BR>Send questions or comments to the NASA Responsible Official at <A href="mailto:jsc-earthweb@mail.nasa.gov">jsc-earthweb@mail.nasa.gov</A><BR>Curator: <A onclick="window.open('/credits.htm', 'win1', config='height=598, width=500')" href="http://eol.jsc.nasa.gov/#" alt="Web Team">Earth Sciences Web Team</A><BR>Notices: <A href="http://www.jsc.nasa.gov/policies.html" target=_blank>Web Accessibility and Policy Notices, NASA Web Privacy Policy</A><BR><!--{PS..5}--></FONT></P>
 $[geDirections]"""
-                                                )
-                                    ),
-                                    id="sn_style"
-                            ),
-                            K.Style(
-                                    K.LabelStyle(K.scale("1.1")),
-                                    K.IconStyle(
-                                        K.scale(1.2),
-                                        K.Icon(K.href("http://maps.google.com/mapfiles/kml/shapes/camera.png"))
-                                    ),
-                                    K.BalloonStyle(
-
-                                        K.text(
+                                )
+                    ),
+                    id="sn_style"
+            ),
+            K.Style(
+                    K.LabelStyle(K.scale("1.1")),
+                    K.IconStyle(
+                        K.scale(1.2),
+                        K.Icon(K.href("http://maps.google.com/mapfiles/kml/shapes/camera.png"))
+                    ),
+                    K.BalloonStyle(
+
+                        K.text(
 """<![CDATA[<P><STRONG><FONT size=4>$[MRF]</FONT</STRONG></P><P><IMG alt="$[MRF] image" src="$[IMG]" align=top></P>
 
 <P>&nbsp;</P>
@@ -457,29 +2231,552 @@ $[geDirections]"""
 
 <P align=center><FONT face=Arial>&nbsp;Image Science and Analysis Laboratory, NASA-Johnson Space Center. "The Gateway to Astronaut Photography of Earth." <BR><A href="http://eol.jsc.nasa.gov/"><IMG height=71 alt="Crew Earth Observations" src="http://eol.jsc.nasa.gov/images/CEO.jpg" width=82 align=left border=0></A> <A href="http://www.nasa.gov/" target=_blank><IMG height=71 alt="NASA meatball" src="http://eol.jsc.nasa.gov/images/NASA.jpg" width=82 align=right border=0></A> <!--{PS..3}--><!--{PS..4}--><!--{PS..6}--><BR>Send questions or comments to the NASA Responsible Official at <A href="mailto:jsc-earthweb@mail.nasa.gov">jsc-earthweb@mail.nasa.gov</A><BR>Curator: <A onclick="window.open('/credits.htm', 'win1', config='height=598, width=500')" href="http://eol.jsc.nasa.gov/#" alt="Web Team">Earth Sciences Web Team</A><BR>Notices: <A href="http://www.jsc.nasa.gov/policies.html" target=_blank>Web Accessibility and Policy Notices, NASA Web Privacy Policy</A><BR><!--{PS..5}--></FONT></P>
 $[geDirections]"""
-                                                )
-                                    ),
-                                    id="sh_style"
-                            ),
-                            K.StyleMap(
-                                    K.Pair(
-                                        K.key("normal"),
-                                        K.styleUrl("#sn_style")
-                                    ),
-                                    K.Pair(
-                                        K.key("highlight"),
-                                        K.styleUrl("#sh_style")
-                                    ),
-                                    id="sm_style"
+                                )
+                    ),
+                    id="sh_style"
+            ),
+            K.StyleMap(
+                    K.Pair(
+                        K.key("normal"),
+                        K.styleUrl("#sn_style")
+                    ),
+                    K.Pair(
+                        K.key("highlight"),
+                        K.styleUrl("#sh_style")
+                    ),
+                    id="sm_style"
+            )
+            ]
+
+def kmlHeader(*elements):
+    '''Returns: the serialized kml document, holding elements such as the
+styles, up to where the placemarks begin'''
+    text = etree.tostring(K.kml(K.Document(*elements)))
+    return text[:text.rindex("</Document>")]
+
+def serializePlacemark(placemark):
+    '''Serializes a placemark to be written between kmlHeader() and kmlfooter
+
+The namespace declarations are left to the enclosing kml element, so the
+result is the same as serializing the whole document at once'''
+    return etree.tostring(placemark).replace(nsdecl,"",1)
+
+def coordinates(attr):
+    '''Returns: (longitude, latitude) of the placemark attributes as numbers, or (None, None)'''
+    try:
+        return float(attr["Longitude"]),float(attr["Latitude"])
+    except (KeyError,ValueError):
+        return None,None
+
+def exportValues(attr):
+    '''Returns: the values of the exportfields of the placemark attributes,
+without the spaces placeMaker keeps around some of them, such as the one
+before HHMMSS'''
+    return [attr.get(field,"").strip() for name,field in exportfields]
+
+class GeoJSONSink(object):
+    '''Writes each photograph to fileName as a line of newline-delimited
+GeoJSON, a Point feature with the exportfields as its properties
+
+Each line is assembled from strings quoted by json, as json.dumps is
+several times slower for the latin-1 strings of the attributes.'''
+
+    def __init__(self,fileName):
+        self.file = open(fileName,"w")
+        self.names = [json.dumps(name)+": " for name,field in exportfields]
+
+    def add(self,image,attr):
+        lon,lat = coordinates(attr)
+        if lon == None:
+            geometry = "null"
+        else:
+            geometry = '{"type": "Point", "coordinates": [%r, %r]}' % (lon,lat)
+
+        properties = ", ".join([name + quote(value.decode("latin-1")) for name,value in zip(self.names,exportValues(attr))])
+        self.file.write('{"type": "Feature", "geometry": ' + geometry + ', "properties": {' + properties + '}}\n')
+
+    def close(self):
+        self.file.close()
+
+class CSVSink(object):
+    '''Writes each photograph to fileName as a row of CSV, its longitude and
+latitude followed by the exportfields, under a row of column names'''
+
+    def __init__(self,fileName):
+        self.file = open(fileName,"wb")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["Longitude","Latitude"] + [name for name,field in exportfields])
+
+    def add(self,image,attr):
+        self.writer.writerow([attr.get("Longitude",""),attr.get("Latitude","")] + exportValues(attr))
+
+    def close(self):
+        self.file.close()
+
+class NPZSink(object):
+    '''Writes the photographs to fileName as a NumPy .npz archive holding an
+array for each column: Longitude, Latitude and the numericfields as
+floats (NaN where missing), the other exportfields as byte strings.
+The columns are collected in memory and saved when the sink is closed.'''
+
+    def __init__(self,fileName):
+        #numpy is only needed for this output
+        import numpy
+        self.numpy = numpy
+        self.fileName = fileName
+        self.columns = collections.OrderedDict([("Longitude",array.array("d")),("Latitude",array.array("d"))])
+        for name,field in exportfields:
+            self.columns[name] = array.array("d") if name in numericfields else []
+
+    def add(self,image,attr):
+        lon,lat = coordinates(attr)
+        self.columns["Longitude"].append(float("nan") if lon == None else lon)
+        self.columns["Latitude"].append(float("nan") if lat == None else lat)
+
+        for (name,field),value in zip(exportfields,exportValues(attr)):
+            if name in numericfields:
+                try:
+                    value = float(value)
+                except ValueError:
+                    value = float("nan")
+            self.columns[name].append(value)
+
+    def close(self):
+        numpy = self.numpy
+        columns = {}
+        for name,values in self.columns.iteritems():
+            if isinstance(values,array.array):
+                columns[name] = numpy.frombuffer(values,dtype=float) if len(values) > 0 else numpy.zeros(0)
+            else:
+                columns[name] = numpy.array(values,dtype=str)
+
+        #older versions of numpy can't compress
+        save = getattr(numpy,"savez_compressed",numpy.savez)
+        save(open(self.fileName,"wb"),**columns)
+
+def renderChunk(chunk):
+    '''Makes and serializes the placemarks of chunk, a list of (attr, styleUrl),
+in a worker process of the pool used by buildPlacemarks
+
+Returns: list of serialized placemarks, None for those placeMaker failed on'''
+    rendered = []
+    for attr,styleUrl in chunk:
+        placemark = placeMaker(attr,styleUrl)
+        rendered += [None if placemark == None else serializePlacemark(placemark)]
+    return rendered
+
+def buildPlacemarks(placemarks,index=None,styleUrl="#sm_style",pool=None,sinks=(),keep=None):
+    '''Makes and serializes a placemark for each image with placeMaker and
+serializePlacemark, reporting those that failed. Every image is also
+recorded in index (a PhotoIndex) if it is given, and those whose
+placemark was made are added to each of sinks (such as a GeoJSONSink),
+so they hold the same photographs as the kml. If keep is given only the
+placemarks whose attributes it returns True for are made, for a writer
+that can't take the others.
+
+placemarks is a generator of (image, attr, error) such as fetchPlacemarks
+or PhotoIndex.query. If pool (a multiprocessing.Pool) is given the
+placemarks are made in chunks of renderchunk by its worker processes, at
+most renderwindow chunks at a time, and handed back in their original
+order so the output is the same as without it.
+
+Returns: generator of (attr, serialized placemark)'''
+    counter = itertools.count(1)
+
+    #report on each image, passing on those that have attributes
+    def accepted():
+        for image,attr,error in placemarks:
+            if not index == None:
+                index.add(image,attr)
+
+            if not error == None:
+                print ("Failed to open URL<%(Page)s>: "+placemarkurl)%image
+                print error
+            if attr == None:
+                print ("Error Parsing URL<%(Page)s>: "+placemarkurl)%image
+                metrics.count("placemarks missing")
+            elif keep == None or keep(attr):
+                yield image,attr
+
+            ct = counter.next()
+            if ct%10 == 0:
+                sys.stdout.write(".")
+                sys.stdout.flush()
+
+        print "\nProcessed " + repr(counter.next()-1) + " images"
+        if not index == None:
+            index.flush()
+
+    def export(image,attr):
+        for sink in sinks:
+            with metrics.timed("export"):
+                sink.add(image,attr)
+
+    if pool == None:
+        for image,attr in accepted():
+            with metrics.timed("placemark build"):
+                placemark = placeMaker(attr,styleUrl)
+            if not placemark == None:
+                with metrics.timed("serialization"):
+                    text = serializePlacemark(placemark)
+                export(image,attr)
+                yield attr,text
+        return
+
+    pending = collections.deque()
+    attrs = accepted()
+    while True:
+        chunk = list(itertools.islice(attrs,renderchunk))
+        if len(chunk) > 0:
+            pending.append((chunk,pool.apply_async(renderChunk,([(attr,styleUrl) for image,attr in chunk],))))
+            metrics.count("placemark chunks")
+
+        #hand back the oldest chunk once the window is full or every chunk is sent
+        while len(pending) > renderwindow or (len(chunk) == 0 and len(pending) > 0):
+            done,rendered = pending.popleft()
+            with metrics.timed("placemark render wait"):
+                rendered = rendered.get()
+            for (image,attr),text in zip(done,rendered):
+                if not text == None:
+                    export(image,attr)
+                    yield attr,text
+
+        if len(chunk) == 0:
+            return
+
+def writeKML(output,placemarks,index=None,pool=None,sinks=()):
+    '''Writes the search results out as a kml file containing placemarks
+
+Each placemark is made by buildPlacemarks, in the worker processes of
+pool if it is given, and written out as soon as it is ready so memory use
+stays flat however many images there are. The images are also written to
+sinks, see buildPlacemarks. output is a file name, or a file object such
+as an HTTP response which is left open.'''
+    if isinstance(output,basestring):
+        kmlfile = open(output,'w')
+    else:
+        kmlfile = output
+    
+    print "\nWriting images to kml"
+
+    kmlfile.write(kmlHeader(*kmlStyles()))
+
+    for attr,text in buildPlacemarks(placemarks,index,"#sm_style",pool,sinks):
+        kmlfile.write(text)
+        metrics.count("placemarks written")
+
+    kmlfile.write(kmlfooter)
+    if isinstance(output,basestring):
+        kmlfile.close()
+    else:
+        kmlfile.flush()
+
+    print "\nDone!"
+
+def quadtree(lons,lats,indices,bounds,leafsize,key=""):
+    '''Divides the points (lons[i], lats[i]) numbered in indices between the
+cells of a quadtree over bounds (minlon, minlat, maxlon, maxlat), splitting
+cells holding more than leafsize points. The points stay in the order of
+indices within each cell.
+
+Returns: list of (quadkey, cell bounds, indices) for the non-empty leaves'''
+    if len(indices) <= leafsize or len(key) >= maxdepth:
+        return [(key,bounds,indices)]
+
+    minlon,minlat,maxlon,maxlat = bounds
+    midlon = (minlon+maxlon)/2
+    midlat = (minlat+maxlat)/2
+
+    quadrants = [[],[],[],[]]
+    for i in indices:
+        quadrants[(lons[i] >= midlon) + 2*(lats[i] >= midlat)].append(i)
+
+    cells = [(minlon,minlat,midlon,midlat),(midlon,minlat,maxlon,midlat),
+             (minlon,midlat,midlon,maxlat),(midlon,midlat,maxlon,maxlat)]
+
+    leaves = []
+    for number in xrange(4):
+        if len(quadrants[number]) > 0:
+            leaves += quadtree(lons,lats,quadrants[number],cells[number],leafsize,key+repr(number))
+    return leaves
+
+def kmlRegionLinks(leaves):
+    '''Builds the root document of a kmz, which loads the kml of each leaf
+of the quadtree (see quadtree) once its cell is in view
+
+Returns: kml element'''
+    document = K.Document()
+    for key,(west,south,east,north),indices in leaves:
+        document.append(K.NetworkLink(
+                            K.name("q"+key),
+                            K.Region(
+                                K.LatLonAltBox(K.north(north),K.south(south),K.east(east),K.west(west)),
+                                K.Lod(K.minLodPixels(128),K.maxLodPixels(-1))
                             ),
-                            *placemarks
+                            K.Link(
+                                K.href("tiles/q%s.kml" % key),
+                                K.viewRefreshMode("onRegion")
                             )
-                )
-    from lxml import etree
-    kmlfile.write(etree.tostring(doc))
+                        ))
+    return K.kml(document)
+
+def writeKMZ(fileName,placemarks,index=None,leafsize=1000,pool=None,sinks=()):
+    '''Writes the search results out as a kmz file, dividing the placemarks
+between the leaves of a quadtree over their longitude and latitude with
+no more than leafsize in each
+
+Each leaf is written as a kml file of its own, tiles/q<quadkey>.kml, which
+the root doc.kml loads through a NetworkLink only when its Region is in
+view. The styles are shared by every leaf from styles.kml. Placemarks are
+made by buildPlacemarks, in the worker processes of pool if it is given,
+and kept in a temporary file until they have all arrived and the
+quadtree can be built. The images are also written to sinks, see
+buildPlacemarks, apart from those without a location which are left out
+of both.'''
+    spill = tempfile.TemporaryFile()
+    lons = array.array("d")
+    lats = array.array("d")
+    offsets = array.array("L",[0])
+
+    print "\nWriting images to kmz"
+
+    #a placemark can only be placed in a tile if it has a location, the
+    #others are left out of the sinks as well
+    def located(attr):
+        if coordinates(attr)[0] == None:
+            print "No location for " + attr["MRF"] + ", left out of the kmz"
+            metrics.count("placemarks unlocated")
+            return False
+        return True
+
+    for attr,text in buildPlacemarks(placemarks,index,"../styles.kml#sm_style",pool,sinks,located):
+        lon,lat = coordinates(attr)
+        spill.write(text)
+        offsets.append(offsets[-1]+len(text))
+        lons.append(lon)
+        lats.append(lat)
+        metrics.count("placemarks written")
+
+    leaves = quadtree(lons,lats,range(len(lons)),(-180.0,-90.0,180.0,90.0),leafsize)
+    print "Dividing them between " + repr(len(leaves)) + " tiles"
+    metrics.count("kmz tiles",len(leaves))
+
+    with metrics.timed("serialization"):
+        kmz = zipfile.ZipFile(fileName,"w",zipfile.ZIP_DEFLATED)
+        kmz.writestr("doc.kml",etree.tostring(kmlRegionLinks(leaves)))
+        kmz.writestr("styles.kml",etree.tostring(K.kml(K.Document(*kmlStyles()))))
+
+        for key,bounds,indices in leaves:
+            text = [kmlHeader(K.name("q"+key))]
+            for i in indices:
+                spill.seek(offsets[i])
+                text += [spill.read(offsets[i+1]-offsets[i])]
+            text += [kmlfooter]
+            kmz.writestr("tiles/q%s.kml" % key,"".join(text))
+
+        kmz.close()
+    spill.close()
 
     print "\nDone!"
 
+class PhotoServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    '''Answers bbox, region and GeoJSON polygon queries over HTTP, see -d
+
+Each request is answered by a thread of its own and streamed back as kml
+by writeKML while its placemarks arrive. Everything worth keeping between
+requests is shared by them: the browser sessions, which are handed out
+one per request, the cache and index, the placemarks fetched so far in
+store (a PlacemarkStore), the worker processes of pool, the prepared
+ShapeFilter of the last shapecache polygons, and the images found by
+the last searchcache searches, which are reused for searchttl seconds
+and then dropped. options are the command line options, which each
+request may add to, see requestoptions.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,address,options,cache=None,index=None,store=None,pool=None):
+        BaseHTTPServer.HTTPServer.__init__(self,address,PhotoHandler)
+        self.options = options
+        self.cache = cache
+        self.index = index
+        self.store = store
+        self.pool = pool
+        self.browsers = Queue.Queue()
+        self.shapes = collections.OrderedDict()
+        self.searches = collections.OrderedDict()
+        self.searchttl = float(options.get("search-ttl",600))
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def browser(self):
+        '''Lends a browser session for the length of a with statement'''
+        try:
+            br = self.browsers.get_nowait()
+        except Queue.Empty:
+            br = newBrowser()
+        try:
+            yield br
+        finally:
+            self.browsers.put(br)
+
+    def shape(self,text):
+        '''Returns: the ShapeFilter of the GeoJSON polygons in text'''
+        with self.lock:
+            rs = self.shapes.pop(text,None)
+        if rs == None:
+            importShapes(False)
+            rs = ShapeFilter(geojsonShapes(json.loads(text)))
+            metrics.count("shapes prepared")
+        with self.lock:
+            self.shapes[text] = rs
+            while len(self.shapes) > shapecache:
+                self.shapes.popitem(False)
+        return rs
+
+    def search(self,key,bbox,regions,rs,options,br):
+        '''Searches the NASA site with searchImages, unless the same search
+was made less than searchttl seconds ago
+
+Returns: generator of {Mission, Roll, Frame, Latitude, Longitude, Page}'''
+        with self.lock:
+            self.expire()
+            found = self.searches.pop(key,None)
+            if not found == None:
+                self.searches[key] = found
+        if not found == None:
+            metrics.count("searches reused")
+            return iter(found[1])
+        return self.remember(key,searchImages(bbox,regions,rs,options,br))
+
+    def remember(self,key,images):
+        '''Passes on images, keeping them for search once they have all arrived'''
+        found = []
+        try:
+            for image in images:
+                found += [image]
+                yield image
+        finally:
+            if hasattr(images,"close"):
+                images.close()
+        with self.lock:
+            self.searches.pop(key,None)
+            self.searches[key] = (time.time(),found)
+            self.expire()
+
+    def expire(self):
+        '''Drops the searches older than searchttl seconds, and the least
+recently used beyond searchcache of them'''
+        now = time.time()
+        for key,(searched,found) in self.searches.items():
+            if now-searched >= self.searchttl:
+                del self.searches[key]
+        while len(self.searches) > searchcache:
+            self.searches.popitem(False)
+
+class PhotoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers a request to PhotoServer
+
+GET /kml?bbox=<MinLon>,<MinLat>,<MaxLon>,<MaxLat> or /kml?region=<Region>
+and POST /kml with a GeoJSON polygon as the body return the kml of the
+images found, and GET /metrics the metrics so far as json.'''
+
+    def do_GET(self):
+        path,query = (self.path.split("?",1)+[""])[:2]
+        if path == "/metrics":
+            self.reply("application/json",json.dumps(metrics.report(),indent=1,sort_keys=True))
+        elif path == "/kml":
+            self.answer(urlparse.parse_qs(query,True))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        path,query = (self.path.split("?",1)+[""])[:2]
+        if not path == "/kml":
+            self.send_error(404)
+            return
+        self.answer(urlparse.parse_qs(query,True),self.rfile.read(int(self.headers.get("Content-Length",0))))
+
+    def reply(self,contentType,body):
+        self.send_response(200)
+        self.send_header("Content-Type",contentType)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def answer(self,query,polygon=None):
+        '''Streams back the kml of the query, see PhotoServer'''
+        server = self.server
+        options = dict(server.options)
+        rs = None
+        regions = None
+        bbox = None
+        try:
+            for name in requestoptions:
+                if name in requestflags and name in query:
+                    if query[name][-1].lower() in ("","1","true","yes","on"):
+                        options[name] = True
+                    elif query[name][-1].lower() in ("0","false","no","off"):
+                        options.pop(name,None)
+                    else:
+                        raise ValueError(name + " should be 1 or 0")
+                elif query.get(name,[""])[-1]:
+                    options[name] = query[name][-1]
+
+            if "tile" in options and not float(options["tile"]) > 0:
+                raise ValueError("tile should be more than 0 degrees")
+            if "tile-pages" in options and not int(options["tile-pages"]) > 0:
+                raise ValueError("tile-pages should be at least 1")
+
+            offline = "offline" in options
+            if not polygon == None:
+                rs = server.shape(polygon)
+                bbox = rs.bounds
+            elif "bbox" in query:
+                bbox = tuple(float(value) for value in query["bbox"][-1].split(","))
+                if not len(bbox) == 4:
+                    raise ValueError("bbox needs 4 numbers")
+            elif "region" in query:
+                regions = query["region"]
+                if offline:
+                    raise ValueError("Predefined regions can't be searched offline")
+            else:
+                raise ValueError("bbox, region or a GeoJSON polygon is needed")
+            if offline and server.index == None:
+                raise ValueError("offline needs the local index")
+            photofilter = photoFilter(options)
+        except (ValueError,TypeError,KeyError), e:
+            self.send_error(400,str(e))
+            return
+
+        print "Request: " + self.path
+
+        #the browser is only handed back once the threads of a reply that
+        #was cut short have stopped using it
+        with server.browser() as br:
+            placemarks = None
+            try:
+                if offline:
+                    placemarks = searchIndex(server.index,bbox,rs,photofilter)
+                    index = None
+                else:
+                    key = json.dumps([bbox,regions,polygon,options.get("tile"),options.get("tile-pages")])
+                    images = server.search(key,bbox,regions,rs,options,br)
+                    if not photofilter == None:
+                        images = filterRows(images,photofilter)
+                    placemarks = fetchPlacemarks(images,int(options.get("threads",8)),float(options.get("rate",0)),
+                                                 server.cache,None,int(options.get("retries",4)),server.store,
+                                                 photofilter,server.index)
+                    index = server.index
+
+                self.send_response(200)
+                self.send_header("Content-Type","application/vnd.google-earth.kml+xml")
+                self.end_headers()
+                writeKML(self.wfile,placemarks,index,server.pool)
+            finally:
+                if hasattr(placemarks,"close"):
+                    placemarks.close()
+
 
 if __name__=="__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#Synthetic stand-ins for the pages served by eol.jsc.nasa.gov,
+#laid out the way AstroKML.py expects to find them
+
+import math,random
+
+regions = ["Africa","Antarctica","Asia","Australia","Europe","North America","South America"]
+
+#regions whose searches find no images
+emptyregions = ["Antarctica"]
+
+def technicalForm():
+    '''Builds the search form of technical.htm
+
+Returns: page html'''
+    options = "".join(['<OPTION value="%s">%s</OPTION>' % (region,region) for region in regions])
+    return ('<HTML><BODY>\n<FORM name="sqlform" method="post" action="/scripts/sseop/technical.pl">\n'
+            '<INPUT type="text" name="minlat"><INPUT type="text" name="maxlat">\n'
+            '<INPUT type="text" name="minlon"><INPUT type="text" name="maxlon">\n'
+            '<INPUT type="checkbox" name="geoncb" value="on">\n'
+            '<SELECT name="geon" multiple>' + options + '</SELECT>\n'
+            '<SELECT name="imagesize"><OPTION value="any">any</OPTION><OPTION value="large">large</OPTION></SELECT>\n'
+            '<INPUT type="submit"></FORM>\n</BODY></HTML>')
+
+def resultRows(page,rows,bbox=(-180.0,-60.0,180.0,60.0),seed=0):
+    '''Makes up the images on a page of search results, lying within bbox
+(minlon, minlat, maxlon, maxlat). The coordinates are random but
+repeatable for a given seed and page
+
+Returns: list of (Mission, Roll, Frame, Latitude, Longitude)'''
+    rand = random.Random(seed*100003+page)
+
+    images = []
+    for row in xrange(rows):
+        frame = (page-1)*rows+row+1
+        images += [("ISS%03d" % (frame%40+1),"E",repr(frame),
+                    "%.1f" % rand.uniform(bbox[1],bbox[3]),"%.1f" % rand.uniform(bbox[0],bbox[2]))]
+    return images
+
+def latticeRows(bbox,spacing):
+    '''Lists the images of a fixed world-wide lattice, spacing degrees apart,
+lying within bbox (minlon, minlat, maxlon, maxlat) edges included. Unlike
+resultRows the same image is always found at the same place, so the
+results of overlapping searches can be merged
+
+Returns: list of (Mission, Roll, Frame, Latitude, Longitude)'''
+    columns = int(round(360/spacing))
+
+    images = []
+    for row in xrange(int(math.ceil((bbox[1]+90)/spacing)),int(math.floor((bbox[3]+90)/spacing))+1):
+        for column in xrange(int(math.ceil((bbox[0]+180)/spacing)),int(math.floor((bbox[2]+180)/spacing))+1):
+            frame = row*columns+column
+            images += [("ISS%03d" % (frame%40+1),"E",repr(frame),
+                        "%.4f" % (row*spacing-90),"%.4f" % (column*spacing-180))]
+    return images
+
+def resultPage(page,pages,images,query=""):
+    '''Builds page of pages of search results listing images (see resultRows).
+query is carried by the GoToPage form to request the other pages
+
+Returns: page html'''
+    html = ["<HTML><BODY>\nPage <b>%d</b> of <b>%d</b><br>\n" % (page,pages),
+            "<CENTER><TABLE border=1>\n<tr><th>Quick View</th><th>Mission</th><th>Roll</th><th>Frame</th>"
+            "<th>Date</th><th>Time</th><th>Latitude</th><th>Longitude</th></tr>\n"]
+
+    for mission,roll,frame,lat,lon in images:
+        html += ['<tr><TD><A href="/scripts/sseop/photo.pl?frame=%s"><IMG src="thumb.jpg"></A></TD>' % frame,
+                 '<TD valign="top">%s</TD><TD valign="top">%s</TD>' % (mission,roll),
+                 '<TD valign="top"><A href="/scripts/sseop/photo.pl?frame=%s" target="_blank">%s</A></TD>' % (frame,frame),
+                 '<TD valign="top">2001-03-04</TD><TD valign="top">12:34:56</TD>',
+                 '<TD valign="top">%s</TD><TD valign="top">%s</TD></tr>\n' % (lat,lon)]
+
+    html += ["</TABLE></CENTER>\n",
+             '<FORM name="GoToPage" method="post" action="/scripts/sseop/technical.pl">'
+             '<INPUT type="hidden" name="query" value="%s">'
+             '<INPUT type="text" name="page" value="%d"><INPUT type="submit"></FORM>\n' % (query,min(page+1,pages)),
+             "</BODY></HTML>"]
+
+    return "".join(html)
+
+def emptyPage():
+    '''Builds the page returned by a search that finds no images,
+which has neither a page count nor a table of results
+
+Returns: page html'''
+    return "<HTML><BODY>\n<P>No photographs were found matching your criteria.</P>\n</BODY></HTML>"
+
+def photoKML(mrf,lat,lon,seed=0):
+    '''Builds the PhotoKML.pl document of image mrf (Mission-Roll-Frame),
+one line per field in the order PhotoKML.pl lays them out
+
+Returns: kml text'''
+    rand = random.Random("%s %d" % (mrf,seed))
+    mission,roll,frame = mrf.split("-")
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?><kml xmlns="http://earth.google.com/kml/2.1"><Placemark>',
+             '<open>0</open>',
+             '<name>%s</name>' % mrf,
+             '<Style>',
+             '<IconStyle>',
+             '<scale>1.0</scale>',
+             '<color>ff00ffff</color>',
+             '<Icon><href>http://maps.google.com/mapfiles/kml/shapes/camera.png</href></Icon>',
+             '</IconStyle>',
+             '</Style>',
+             '<Point>',
+             '<coordinates>%s,%s,0</coordinates>' % (lon,lat),
+             '</Point>',
+             '<LookAt>',
+             '<tilt>0</tilt>',
+             '<longitude>%s</longitude>' % lon,
+             '<latitude>%s</latitude>' % lat,
+             '<range>40000</range>',
+             '</LookAt>',
+             '<description><![CDATA[<P><STRONG><FONT size=4>%s</FONT></STRONG></P>' % mrf,
+             '<P><IMG alt="%s image" src="http://eol.jsc.nasa.gov/sseop/images/ESC/small/%s/%s.JPG" align=top></P>' % (mrf,mission,mrf),
+             '<P>&nbsp;</P>',
+             '<P><STRONG><FONT size=4>Astronaut Photograph</FONT></STRONG></P>',
+             '<P><STRONG>Features</STRONG>: %s</P>' % rand.choice(["LAKE TAHOE, CA","NILE DELTA","ANDES MTNS.","CLOUDS"]),
+             '<P><STRONG>Acquired</STRONG>: %04d%02d%02d (YYYYMMDD), %02d%02d%02d (HHMMSS) GMT</P>' % (
+                 rand.randint(1990,2010),rand.randint(1,12),rand.randint(1,28),rand.randint(0,23),rand.randint(0,59),rand.randint(0,59)),
+             '<P><STRONG>Camera Tilt</STRONG>: %s&nbsp; <STRONG>Camera Lens</STRONG>: %s&nbsp; <STRONG>Camera</STRONG>: %s</P>' % (
+                 rand.choice(["NV","LO","HO"]),rand.choice(["180 mm","400 mm","800 mm"]),rand.choice(["E4: Kodak DCS760C Electronic Still Camera","N1: Nikon D1"])),
+             '<P><STRONG>Sun Azimuth</STRONG>: %d&nbsp; <STRONG>Sun Elevation</STRONG>: %d&nbsp;<STRONG>Spacecraft Altitude</STRONG>: %d nautical miles</P>' % (
+                 rand.randint(0,359),rand.randint(-30,90),rand.randint(150,250)),
+             "<P><STRONG>Database Entry Page</STRONG>: <FONT face=Arial><A href='http://eol.jsc.nasa.gov/scripts/sseop/photo.pl?mission=%s&roll=%s&frame=%s'>Link</A></FONT></P>" % (mission,roll,frame),
+             ']]></description>',
+             '</Placemark></kml>']
+
+    return "\n".join(lines)+"\n"
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Local stand-in for the parts of eol.jsc.nasa.gov used by AstroKML.py
+#
+#Usage
+#   python bench/mirror.py [--port=8000] [--pages=10] [--rows=50] [--latency=<ms>]
+#                          [--errors=<fraction>] [--spacing=<degrees>] [--recordings=<Directory>]
+#
+#then point AstroKML.py at it with --site=http://localhost:8000
+#
+#Recorded copies of the site are served in place of the synthetic pages
+#when they are found in the recordings directory:
+#   <Directory>/technical.htm          the search form
+#   <Directory>/results/<Page>.html    a page of search results
+#   <Directory>/PhotoKML/<M-R-F>.kml   the PhotoKML.pl document of an image
+
+import os,time,random,threading,urlparse,optparse,hashlib,zlib
+import BaseHTTPServer,SocketServer
+
+import fixtures
+
+class MirrorServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    '''Serves the search form, search results and PhotoKML.pl documents
+
+Every search returns pages pages of rows images lying within its
+bounding box. With spacing set bounding box searches instead find the
+images of a lattice spacing degrees apart (see fixtures.latticeRows), so
+the number of pages grows with the area searched. Searches of
+fixtures.emptyregions, and those of bounding boxes holding none of the
+lattice, find nothing (see fixtures.emptyPage). Each response is delayed
+by latency seconds and a fraction errors of them fail with a 500 error. Connections are kept alive,
+responses are gzip compressed when the client accepts it and carry an
+ETag so unchanged documents can be revalidated. stats counts the
+requests and bytes served of each kind.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,address,pages=10,rows=50,latency=0,errors=0,recordings=None,seed=0,spacing=0):
+        BaseHTTPServer.HTTPServer.__init__(self,address,MirrorHandler)
+        self.pages = pages
+        self.rows = rows
+        self.latency = latency
+        self.errors = errors
+        self.recordings = recordings
+        self.seed = seed
+        self.spacing = spacing
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        #coordinates of the images listed in search results, used by PhotoKML.pl
+        self.located = {}
+
+        self.reset()
+
+    def reset(self):
+        '''Clears stats'''
+        with self.lock:
+            self.stats = {}
+
+    def count(self,kind,size):
+        with self.lock:
+            total = self.stats.setdefault(kind,[0,0])
+            total[0] += 1
+            total[1] += size
+
+    def recorded(self,*path):
+        '''Returns: the contents of a recorded response, or None'''
+        if self.recordings == None:
+            return None
+        fileName = os.path.join(self.recordings,*path)
+        if not os.path.exists(fileName):
+            return None
+        return open(fileName,"rb").read()
+
+    def results(self,query,page):
+        '''Returns: page html of the search described by query'''
+        recorded = self.recorded("results","%d.html" % page)
+        if not recorded == None:
+            return recorded
+
+        bbox = (-180.0,-60.0,180.0,60.0)
+        if query.startswith("b:"):
+            bbox = tuple(float(value) for value in query[2:].split(","))
+
+        pages = self.pages
+        if query.startswith("r:") and set(query[2:].split("|")) <= set(fixtures.emptyregions):
+            return fixtures.emptyPage()
+        elif self.spacing and query.startswith("b:"):
+            images = fixtures.latticeRows(bbox,self.spacing)
+            if len(images) == 0:
+                return fixtures.emptyPage()
+            pages = (len(images)+self.rows-1)//self.rows
+            images = images[(page-1)*self.rows:page*self.rows]
+        else:
+            images = fixtures.resultRows(page,self.rows,bbox,self.seed)
+        with self.lock:
+            for mission,roll,frame,lat,lon in images:
+                self.located["%s-%s-%s" % (mission,roll,frame)] = (lat,lon)
+
+        return fixtures.resultPage(page,pages,images,query)
+
+    def photo(self,mrf):
+        '''Returns: the PhotoKML.pl document of mrf'''
+        recorded = self.recorded("PhotoKML",mrf+".kml")
+        if not recorded == None:
+            return recorded
+
+        with self.lock:
+            lat,lon = self.located.get(mrf,("0.0","0.0"))
+        return fixtures.photoKML(mrf,lat,lon,self.seed)
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self,format,*args):
+        pass
+
+    def do_GET(self):
+        path,query = (self.path.split("?",1)+[""])[:2]
+
+        if path == "/sseop/technical.htm":
+            self.reply("form",self.server.recorded("technical.htm") or fixtures.technicalForm())
+        elif path == "/scripts/sseop/PhotoKML.pl":
+            photo = urlparse.parse_qs(query).get("photo",[""])[0]
+            self.reply("placemark",self.server.photo(photo),"application/vnd.google-earth.kml+xml")
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if not self.path == "/scripts/sseop/technical.pl":
+            self.send_error(404)
+            return
+
+        form = urlparse.parse_qs(self.rfile.read(int(self.headers.get("Content-Length",0))),True)
+
+        #a new search is described by the sqlform fields, the other pages
+        #carry the description in the query field of the GoToPage form
+        if "page" in form:
+            self.reply("page",self.server.results(form.get("query",[""])[0],int(form["page"][0])))
+        elif form.get("minlon",[""])[0]:
+            bbox = ",".join(form[name][0] for name in ("minlon","minlat","maxlon","maxlat"))
+            self.reply("search",self.server.results("b:"+bbox,1))
+        else:
+            self.reply("search",self.server.results("r:"+"|".join(form.get("geon",[])),1))
+
+    def reply(self,kind,body,contentType="text/html"):
+        '''Sends body after the configured latency, or fails at the configured error rate'''
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.errors and server.random.random() < server.errors:
+            server.count("error",0)
+            self.send_error(500)
+            return
+
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            server.count("not modified",0)
+            self.send_response(304)
+            self.send_header("ETag",etag)
+            self.send_header("Content-Length","0")
+            self.end_headers()
+            return
+
+        if "gzip" in self.headers.get("Accept-Encoding",""):
+            compressor = zlib.compressobj(6,zlib.DEFLATED,16+zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            encoding = "gzip"
+        else:
+            encoding = "identity"
+
+        server.count(kind,len(body))
+        self.send_response(200)
+        self.send_header("Content-Type",contentType)
+        self.send_header("Content-Encoding",encoding)
+        self.send_header("ETag",etag)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def main():
+    parser = optparse.OptionParser(usage="python bench/mirror.py [options]")
+    parser.add_option("--port",type="int",default=8000)
+    parser.add_option("--pages",type="int",default=10,help="pages of results returned by each search")
+    parser.add_option("--rows",type="int",default=50,help="images on each page of results")
+    parser.add_option("--latency",type="float",default=0,help="milliseconds added to each response")
+    parser.add_option("--errors",type="float",default=0,help="fraction of requests failing with a 500 error")
+    parser.add_option("--spacing",type="float",default=0,help="degrees between the images found by bounding box searches")
+    parser.add_option("--recordings",help="directory of recorded responses")
+    options,args = parser.parse_args()
+
+    server = MirrorServer(("localhost",options.port),options.pages,options.rows,
+                          options.latency/1000.0,options.errors,options.recordings,spacing=options.spacing)
+    print "Serving on http://localhost:%d" % options.port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__=="__main__":
+    main()
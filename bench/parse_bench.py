@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Micro-benchmarks of the search results table and PhotoKML.pl parsers
+#
+#Usage
+#   python bench/parse_bench.py [<Saved results page> | <Saved PhotoKML.pl document> | <Recordings directory> ...]
+#
+#Without arguments synthetic pages of increasing size and a synthetic
+#corpus of PhotoKML.pl documents are used. Files ending in .kml are read
+#as PhotoKML.pl documents, directories as recordings laid out as for
+#bench/mirror.py. The single pass rowfinder used by getImages is compared
+#against the row by row slicing it replaced, and parsePlacemarkText
+#against the fixed line slicing it replaced.
+
+import os,sys,time,random
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+
+import re
+import AstroKML
+import fixtures
+
+topfinder = re.compile("<TD valign=\"top\">[\-\. a-zA-Z0-9]*</TD>")
+targetfinder = re.compile("target=\"_blank\">[ a-zA-Z0-9]*</A></TD>")
+tdfinder = re.compile("</TD>")
+
+def legacyRows(doc):
+    '''The row loop getImages used before rowfinder, slicing the page row by row
+
+Returns: list of (Mission, Roll, Frame, Latitude, Longitude)'''
+    rows = []
+    doc = doc[AstroKML.startfinder.search(doc).end(0):]
+    doc = doc[:AstroKML.endfinder.search(doc).start(0)]
+    loc = AstroKML.trfinder.search(doc).start(0)
+    doc = doc[loc+5:]
+    loc = AstroKML.trfinder.search(doc).start(0)
+
+    while True:
+        img = doc[:loc]
+        doc = doc[loc+5:]
+        try:
+            loc = AstroKML.trfinder.search(doc).start(0)
+        except:
+            break
+
+        loc2 = topfinder.search(img)
+        mission = img[loc2.start(0)+17:loc2.end(0)-5].replace(" ","")
+        img = img[loc2.end(0):]
+        loc2 = topfinder.search(img)
+        roll = img[loc2.start(0)+17:loc2.end(0)-5].replace(" ","")
+        img = img[loc2.end(0):]
+        loc2 = targetfinder.search(img)
+        frame = img[loc2.start(0)+16:loc2.end(0)-9].replace(" ","")
+        img = img[loc2.end(0):]
+        img = img[tdfinder.search(img).end(0):]
+        img = img[tdfinder.search(img).end(0):]
+        loc2 = topfinder.search(img)
+        lat = img[loc2.start(0)+17:loc2.end(0)-5]
+        img = img[loc2.end(0):]
+        loc2 = topfinder.search(img)
+        lon = img[loc2.start(0)+17:loc2.end(0)-5]
+        rows += [(mission,roll,frame,lat,lon)]
+
+    return rows
+
+def singlePassRows(doc):
+    '''The rowfinder sweep used by getImages
+
+Returns: list of (Mission, Roll, Frame, Latitude, Longitude)'''
+    start = AstroKML.startfinder.search(doc).end(0)
+    start = AstroKML.trfinder.search(doc,start).end(0)
+    end = AstroKML.endfinder.search(doc,start).start(0)
+    return [(row.group(1).replace(" ",""),row.group(2).replace(" ",""),row.group(3).replace(" ",""),
+             row.group(5) or "",row.group(6) or "") for row in AstroKML.rowfinder.finditer(doc,start,end)]
+
+def legacyPlacemark(text):
+    '''The parser fetchPlacemark used before parsePlacemarkText, slicing
+each field out of a fixed line of the document
+
+Returns: the placemark attributes, or None'''
+    lines = []
+    for line in text.splitlines(True):
+        lines += [line]
+
+    if not "<Placemark>" in lines[0]:
+        return
+
+    attr = AstroKML.PlacemarkRecord()
+
+    attr["MRF"]                 = lines[2][lines[2].find("<name>")+6:lines[2].find("</name>")]
+    attr["Color"]               = lines[6][lines[6].find("<color>")+7:lines[6].find("</color")]
+    attr["Elevation"]           = "3000"
+    attr["Tilt"]                = "0"
+    attr["Longitude"]           = lines[15][lines[15].find("<longitude>")+11:lines[15].find("</longitude")]
+    attr["Latitude"]            = lines[16][lines[16].find("<latitude>")+10:lines[16].find("</latitude")]
+    attr["IMG"]                 = lines[20][lines[20].find("src=")+5:lines[20].find(".JPG")+4]
+    attr["Features"]            = lines[23][lines[23].find(": ")+2:lines[23].find("</P>")]
+    attr["YYYYMMDD"]            = lines[24][lines[24].find(": ")+2:lines[24].find(" (")]
+    attr["HHMMSS"]              = lines[24][lines[24].find("DD), ")+4:lines[24].find(" (HH")]
+
+    cline = lines[25]
+    attr["Camera Tilt"]         = cline[cline.find(": ")+2:cline.find("&nbsp")]
+    cline = cline[cline.find(";")+1:]
+    attr["Camera Lens"]         = cline[cline.find(": ")+2:cline.find("&nbsp")]
+    cline = cline[cline.find(";")+1:]
+    attr["Camera"]              = cline[cline.find(": ")+2:cline.find("</P>")]
+
+    cline = lines[26]
+    attr["Sun Azimuth"]         = cline[cline.find(": ")+2:cline.find("&nbsp")]
+    cline = cline[cline.find(";")+1:]
+    attr["Sun Elevation"]       = cline[cline.find(": ")+2:cline.find("&nbsp")]
+    cline = cline[cline.find(";")+1:]
+    attr["Spacecraft Altitude"] = cline[cline.find(": ")+2:cline.find(" nau")]
+
+    attr["DB Entry"]            = lines[27][lines[27].find("='")+2:lines[27].find("'>")]
+
+    return attr
+
+def reordered(text,seed=0):
+    '''Returns: text with its description lines shuffled and an extra line added to its head,
+as a server changing its layout might'''
+    lines = text.splitlines(True)
+    start = [number for number,line in enumerate(lines) if "<description>" in line][0]+1
+    end = [number for number,line in enumerate(lines) if "]]></description>" in line][0]
+    description = lines[start:end]
+    random.Random(seed).shuffle(description)
+    return "".join(lines[:1] + ["<!-- generated -->\n"] + lines[1:start] + description + lines[end:])
+
+def timeParser(parser,doc,repeat=5):
+    '''Returns: (best time in seconds, rows found)'''
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        rows = parser(doc)
+        elapsed = time.time()-start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best,rows
+
+def timeCorpus(parser,docs,repeat=3):
+    '''Returns: (best time in seconds to parse every document, results)'''
+    return timeParser(lambda docs: [parser(doc) for doc in docs],docs,repeat)
+
+def readArguments(names):
+    '''Returns: (list of (name, results page), list of PhotoKML.pl documents) read from names'''
+    pages = []
+    docs = []
+    for name in names:
+        if os.path.isdir(name):
+            results = os.path.join(name,"results")
+            photos = os.path.join(name,"PhotoKML")
+            if os.path.isdir(results):
+                pages += [(page,open(os.path.join(results,page)).read()) for page in sorted(os.listdir(results))]
+            if os.path.isdir(photos):
+                docs += [open(os.path.join(photos,photo)).read() for photo in sorted(os.listdir(photos))]
+        elif name.endswith(".kml"):
+            docs += [open(name).read()]
+        else:
+            pages += [(name,open(name).read())]
+    return pages,docs
+
+def comparePlacemarks(name,docs,expected):
+    '''Times the placemark parsers over docs and prints a line of results,
+including whether each parser found the expected attributes'''
+    def correct(found):
+        return [attr and attr.items() for attr in found] == [attr and attr.items() for attr in expected]
+
+    try:
+        legacy,old = timeCorpus(legacyPlacemark,docs)
+        legacyRate = "%.0f" % (len(docs)/legacy)
+        legacyCorrect = "yes" if correct(old) else "no"
+    except IndexError:
+        legacyRate = legacyCorrect = "failed"
+    single,new = timeCorpus(AstroKML.parsePlacemarkText,docs)
+
+    print "%-20s %8d %12s %12.0f %10s %10s" % (name[:20],len(docs),legacyRate,len(docs)/single,
+                                               legacyCorrect,"yes" if correct(new) else "no")
+
+def main():
+    if len(sys.argv) > 1:
+        pages,docs = readArguments(sys.argv[1:])
+    else:
+        pages = [("%d rows" % rows,fixtures.resultPage(1,1,fixtures.resultRows(1,rows))) for rows in (100,1000,5000,20000)]
+        docs = [fixtures.photoKML("ISS%03d-E-%d" % (frame%40+1,frame),"%.1f" % (frame%120-60),"%.1f" % (frame%360-180))
+                for frame in xrange(5000)]
+
+    print "%-20s %8s %12s %12s %8s" % ("page","rows","legacy r/s","single r/s","speedup")
+    for name,doc in pages:
+        legacy,old = timeParser(legacyRows,doc)
+        single,new = timeParser(singlePassRows,doc)
+
+        #the legacy loop never reaches the row closed by the last </tr>
+        if not old == new[:len(old)]:
+            print name + ": parsers disagree"
+
+        print "%-20s %8d %12.0f %12.0f %7.1fx" % (os.path.basename(name)[:20],len(new),
+                                                  len(old)/legacy,len(new)/single,(legacy/len(old))/(single/len(new)))
+
+    if len(docs) > 0:
+        print
+        print "%-20s %8s %12s %12s %10s %10s" % ("placemarks","docs","legacy d/s","single d/s","legacy ok","single ok")
+
+        #the documents as served are the reference for both parsers
+        expected = map(AstroKML.parsePlacemarkText,docs)
+        comparePlacemarks("as served",docs,expected)
+        comparePlacemarks("reordered",[reordered(doc,seed) for seed,doc in enumerate(docs)],expected)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#End to end benchmarks of AstroKML.py against the local mirror
+#
+#Usage
+#   python bench/run_bench.py [--sizes=1,10,40] [--rows=50] [--latency=<ms>] [--errors=<fraction>]
+#                             [--recordings=<Directory>] [--json=<File>] [-- <AstroKML.py options>]
+#
+#Each of the -b, -r and -s modes is run once for every size (pages of
+#results per search). -s runs need osgeo to write the test shapefile and
+#are skipped without it. Options after -- are passed on to AstroKML.py,
+#for example -- --threads=16
+
+import os,sys,time,json,shutil,tempfile,subprocess,threading,optparse
+
+import mirror
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","AstroKML.py")
+
+bbox = ("-20","-10","20","10")
+
+def writeShapefile(fileName):
+    '''Writes a triangle covering half of bbox to fileName
+
+Returns: True if the shapefile was written'''
+    try:
+        import osgeo.ogr as ogr
+    except ImportError:
+        return False
+
+    dataset = ogr.GetDriverByName("ESRI Shapefile").CreateDataSource(fileName)
+    layer = dataset.CreateLayer("region",None,ogr.wkbPolygon)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkt("POLYGON ((-20 -10,20 -10,20 10,-20 -10))"))
+    layer.CreateFeature(feature)
+    dataset = None
+    return True
+
+def runAstroKML(args):
+    '''Runs AstroKML.py with args
+
+Returns: (exit status, seconds, peak resident memory in MB)'''
+    start = time.time()
+    devnull = open(os.devnull,"w")
+    process = subprocess.Popen([sys.executable,script]+args,stdout=devnull,stderr=subprocess.STDOUT)
+    pid,status,usage = os.wait4(process.pid,0)
+    return status,time.time()-start,usage.ru_maxrss/1024.0
+
+def main():
+    parser = optparse.OptionParser(usage="python bench/run_bench.py [options] [-- <AstroKML.py options>]")
+    parser.add_option("--sizes",default="1,10,40",help="comma separated pages of results per search")
+    parser.add_option("--rows",type="int",default=50,help="images on each page of results")
+    parser.add_option("--latency",type="float",default=20,help="milliseconds added to each response")
+    parser.add_option("--errors",type="float",default=0,help="fraction of requests failing with a 500 error")
+    parser.add_option("--recordings",help="directory of recorded responses")
+    parser.add_option("--json",help="also write the results to this file")
+    options,extra = parser.parse_args()
+
+    server = mirror.MirrorServer(("localhost",0),rows=options.rows,latency=options.latency/1000.0,
+                                 errors=options.errors,recordings=options.recordings)
+    serving = threading.Thread(target=server.serve_forever)
+    serving.daemon = True
+    serving.start()
+    site = "--site=http://localhost:%d" % server.server_address[1]
+
+    work = tempfile.mkdtemp()
+    shapefile = os.path.join(work,"region.shp")
+
+    #the last -r search finds nothing, see fixtures.emptyregions
+    modes = [("-b",list(bbox)),("-r",["Africa","Europe"]),("-r",["Antarctica"])]
+    if writeShapefile(shapefile):
+        modes += [("-s",[shapefile])]
+    else:
+        print "osgeo is not available, skipping -s"
+
+    results = []
+    print "%-4s %6s %7s %9s %9s %12s %9s" % ("mode","pages","images","seconds","pages/s","placemarks/s","peak MB")
+    try:
+        for size in [int(size) for size in options.sizes.split(",")]:
+            for mode,params in modes:
+                server.pages = size
+                server.reset()
+
+                output = os.path.join(work,"out.kml")
+                status,seconds,peak = runAstroKML([mode,output]+params+[site,"--no-cache","--no-index"]+extra)
+
+                stats = server.stats
+                pages = stats.get("search",[0])[0]+stats.get("page",[0])[0]
+                placemarks = stats.get("placemark",[0])[0]
+                result = {"mode":mode,"pages":pages,"images":placemarks,"seconds":seconds,
+                          "pages_per_second":pages/seconds,"placemarks_per_second":placemarks/seconds,
+                          "peak_rss_mb":peak,"errors":stats.get("error",[0])[0],"status":status}
+                results += [result]
+
+                print "%-4s %6d %7d %9.2f %9.1f %12.1f %9.1f%s" % (mode,pages,placemarks,seconds,
+                        result["pages_per_second"],result["placemarks_per_second"],peak,
+                        "" if status == 0 else "  (failed)")
+    finally:
+        server.shutdown()
+        shutil.rmtree(work)
+
+    if options.json:
+        json.dump(results,open(options.json,"w"),indent=1)
+
+if __name__=="__main__":
+    main()
@@ -43,10 +43,12 @@ Dependencies
 mechanize 0.2.5 <http://wwwsearch.sourceforge.net/mechanize>
 pykml 0.3 <http://code.google.com/p/pykml>
 
-Optional (only needed if -s option is used)
+Optional (only needed if -s option is used, numpy also for --npz,
+shapely and numpy also for GeoJSON polygons sent to -d)
 
 gdal 1.7.1 <http://trac.osgeo.org/gdal/wiki/GdalOgrInPython>
 shapely 1.2 <http://trac.gispython.org/lab/wiki/Shapely>
+numpy 1.3 <http://numpy.scipy.org>
 
 ---------
 Installation
@@ -60,7 +62,7 @@ Usage
 
 To load a region defined by a shapefile:
    AstroKML.py -s <Output File> <Shapefile>
-   NOTE: The shapefile must contain a single polygon entry
+   NOTE: The shapefile may contain any number of polygon or multipolygon entries
 
 To load a region defined by a bounding box:
    AstroKML.py -b <Output File> <MinLon> <MinLat> <MaxLon> <MaxLat>
@@ -68,6 +70,95 @@ To load a region defined by a bounding box:
 To use predefined region(s):
    AstroKML.py -r <Output File> <Region1> ...
 
+To run a batch of the above, one per line of a job file:
+   AstroKML.py -j <Job File>
+   NOTE: each line holds the arguments of one query, quoted as on the command line,
+         and may end with options applying only to it, other than --site, --procs,
+         --memory, --metrics and the cache and index options, which are given before -j.
+         A job that can't be run, such as --offline without an index, is skipped
+
+To answer queries over HTTP, keeping sessions and placemarks warm between them:
+   AstroKML.py -d <Port>
+   GET  /kml?bbox=<MinLon>,<MinLat>,<MaxLon>,<MaxLat>   a bounding box
+   GET  /kml?region=<Region1>&region=...                 predefined region(s)
+   POST /kml                                             a GeoJSON polygon as the body
+   NOTE: the filter options, --tile, --tile-pages and --offline may be given
+         with each request, such as /kml?bbox=-10,-10,10,10&from=20010101,
+         --offline only if -d was started with --index
+
 See http://eol.jsc.nasa.gov/sseop/technical.htm for the full list of regions
+
+An <Output File> ending in .kmz is written as a KMZ of kml tiles that
+Google Earth loads as they come into view, see --leaf-size
+
+---------
+Options
+---------
+
+Options may be placed anywhere on the command line:
+
+   --threads=<N>       most placemarks fetched at once (default 8)
+   --rate=<R>          maximum placemark requests started per second (default no limit)
+   --page-threads=<N>  number of result pages fetched at once (default 4)
+   --retries=<N>       times a failed request is retried (default 4)
+   --procs=<N>         make and serialize placemarks in N worker processes (default 1)
+   --memory=<MB>       keep about MB in all of fetched placemarks and resumed results in
+                       memory, spilling the rest to a temporary file (default no limit)
+   --tile=<D>          search -b and -s areas as a grid of tiles D degrees across
+   --tile-pages=<N>    split tiles with more than N pages of results (default 5)
+   --cache=<File>      placemark cache database (default ~/.astrokml_cache.sqlite)
+   --cache-ttl=<D>     days before a cached placemark is fetched again (default 90, 0 never)
+   --cache-size=<N>    maximum number of cached placemarks (default 500000, 0 no limit)
+   --no-cache          don't read or write the placemark cache
+   --refresh           fetch every placemark again, updating the cache
+   --resume            continue an interrupted run from <Output File>.journal
+   --index[=<File>]    add the photographs found to a local index for --offline
+                       (default file ~/.astrokml_index.sqlite)
+   --no-index          don't use the local index, even with --index or --offline
+   --offline           answer -b and -s queries from the local index without the NASA site
+   --from=<YYYYMMDD>   only photographs acquired on or after this date
+   --to=<YYYYMMDD>     only photographs acquired on or before this date
+   --mission=<M,...>   only photographs from these missions, such as ISS001,STS063
+   --tilt=<T,...>      only these camera tilts, such as NV (nadir view),LO,HO
+   --camera=<Text>     only cameras whose name contains Text
+   --lens=<Text>       only lenses whose name contains Text, such as 180
+   --sun-min=<D>       only photographs taken with the sun at least D degrees high
+   --sun-max=<D>       only photographs taken with the sun at most D degrees high
+   --altitude-min=<N>  only photographs taken from at least N nautical miles up
+   --altitude-max=<N>  only photographs taken from at most N nautical miles up
+   --leaf-size=<N>     most placemarks in each kml of a .kmz <Output File> (default 1000)
+   --geojson=<File>    also write the photographs to File as newline-delimited GeoJSON
+   --csv=<File>        also write the photographs to File as CSV
+   --npz=<File>        also write the photographs to File as NumPy arrays (needs numpy)
+   --site=<URL>        send requests to URL instead of http://eol.jsc.nasa.gov, the
+                       default cache and index files are not used with it
+   --metrics=<File>    write timings and counters of each stage as json to File
+   --metrics-interval=<S> also rewrite the metrics file every S seconds while running
+   --host=<Address>    address -d listens on (default localhost)
+   --search-ttl=<S>    seconds -d reuses the results of a search (default 600, 0 never)
+
+The kml of each -d request is streamed back as its placemarks arrive.
+The browser sessions, placemark cache, local index, fetched placemarks
+and prepared polygons are kept between requests, and a search repeated
+within --search-ttl seconds isn't sent to the NASA site again, so areas
+already seen are answered from memory. GET /metrics returns the metrics
+of the requests so far as json.
+
+---------
+Benchmarks
+---------
+
+bench/mirror.py serves a local stand-in for the NASA site, with optional
+latency and error injection. bench/run_bench.py runs the -b, -r and -s
+modes against it and reports pages/s, placemarks/s, peak memory and
+total time:
+
+   python bench/run_bench.py --sizes=1,10,40 --latency=20 -- --threads=16
+
+bench/parse_bench.py measures the throughput of the search results and
+PhotoKML.pl parsers, over synthetic documents or a directory of recorded
+responses laid out as for bench/mirror.py --recordings:
+
+   python bench/parse_bench.py <Recordings directory>
 """
       )